@@ -14,6 +14,8 @@ triplet ambiguities:
     "B": ["C", "G", "T"],
 """
 
+import numpy as np
+
 
 def DoubleAmbigs(n1, n2):
     """Takes primary and secondary nucleotides and returns the corresponding ambiguity nucleotide code.
@@ -226,3 +228,77 @@ def IsAmbiguous(one, two, three, four, cov):
     if AmbigCombination == 2:
         char = DoubleAmbigs(nuc1, nuc2)
         return True, char
+
+
+# Bits of the nucleotides in a set of nucleotides, and the IUPAC code of every set of two or three nucleotides.
+# Sets of three that contain a deletion (X) become N, like they do in IsAmbiguous
+_NUCLEOTIDE_BITS = {"A": 1, "C": 2, "G": 4, "T": 8, "X": 16}
+_IUPAC = np.full(32, "", dtype="<U1")
+for _code, _nucleotides in {
+    "M": "AC",
+    "R": "AG",
+    "W": "AT",
+    "S": "CG",
+    "Y": "CT",
+    "K": "GT",
+    "V": "ACG",
+    "H": "ACT",
+    "D": "AGT",
+    "B": "CGT",
+}.items():
+    _IUPAC[sum(_NUCLEOTIDE_BITS[n] for n in _nucleotides)] = _code
+for _mask in range(16, 32):
+    if bin(_mask).count("1") == 3:
+        _IUPAC[_mask] = "N"
+
+
+def AmbiguityCodes(bases, counts, cov, blocksize=1 << 18):
+    """Does what IsAmbiguous does for all positions at once, from the ranked nucleotides of the index.
+
+    Parameters
+    ----------
+    bases
+        an array of shape (length, 5) with the nucleotides of every position, ordered from the highest to the lowest count
+    counts
+        an array of shape (length, 5) with the counts of these nucleotides
+    cov
+        an array with the coverage of every position
+    blocksize, optional
+        the number of positions that are handled at once, this bounds the size of the intermediate arrays
+
+    Returns
+    -------
+        An array with the ambiguity character of every position, an empty string where the position isn't ambiguous.
+
+    """
+    cov = np.asarray(cov)
+    codes = np.full(len(cov), "", dtype="<U1")
+    for s in range(0, len(cov), blocksize):
+        block = slice(s, s + blocksize)
+        codes[block] = _ambiguity_block(bases[block], counts[block], cov[block])
+    return codes
+
+
+def _ambiguity_block(bases, counts, cov):
+    """AmbiguityCodes of a block of consecutive positions"""
+    codes = np.full(len(cov), "", dtype="<U1")
+    valid = (cov != 0) & (bases[:, 0] != "X") & (bases[:, 1] != "X")
+    if not valid.any():
+        return codes
+
+    # positions without coverage are never ambiguous, they are divided by 1 to keep the percentages finite
+    p = (counts[:, :4] / np.where(cov == 0, 1, cov)[:, None]) * 100
+    # closeness of every pair of the four most common nucleotides
+    maxdistance = 10
+    close = np.abs(p[:, :, None] - p[:, None, :]) <= maxdistance
+    two = valid & close[:, 0, 1]
+    three = two & close[:, 0, 2] & close[:, 1, 2]
+    four = three & close[:, 0, 3] & close[:, 1, 3] & close[:, 2, 3]
+
+    bits = np.zeros(bases.shape[:1] + (3,), dtype=np.int64)
+    for n, bit in _NUCLEOTIDE_BITS.items():
+        bits[bases[:, :3] == n] = bit
+    codes[two] = _IUPAC[bits[two, 0] | bits[two, 1]]
+    codes[three] = _IUPAC[bits[three, 0] | bits[three, 1] | bits[three, 2]]
+    codes[four] = "N"
+    return codes
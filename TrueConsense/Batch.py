@@ -0,0 +1,328 @@
+"""
+Batch mode of TrueConsense, processes all samples of a sample sheet against the same reference and features
+"""
+
+import argparse
+import concurrent.futures as cf
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from .Cache import AddCacheArguments, CacheFromArgs
+from .func import MyHelpFormatter, checkfasta, checkgff, color
+from .indexing import Gffindex, ReadReference, read_override_index
+from .TrueConsense import ProcessSample
+from .version import __version__
+
+# columns of the sample sheet, the names match the long options of the single sample command
+SHEET_REQUIRED = ["samplename", "input", "output"]
+SHEET_OPTIONAL = [
+    "variants",
+    "output-gff",
+    "depth-of-coverage",
+    "index-override-report",
+]
+
+SUMMARY_COLUMNS = [
+    "samplename",
+    "status",
+    "contigs",
+    "length",
+    "N",
+    "ambiguous",
+    "deletions",
+    "mean_coverage",
+    "breadth",
+    "overridden",
+    "message",
+]
+
+# the reference and the features are read once by the parent process, the workers inherit them
+_shared = {}
+
+
+def GetArgs(givenargs):
+    def checkfile(fname):
+        if os.path.isfile(fname):
+            return fname
+        print(f'"{fname}" is not a file. Exiting...')
+        sys.exit(1)
+
+    parser = argparse.ArgumentParser(
+        prog="TrueConsense-batch",
+        usage="%(prog)s [required options] [optional arguments]",
+        description="TrueConsense batch mode: Creating consensus sequences for all samples in a sample sheet against the same reference",
+        formatter_class=MyHelpFormatter,
+        add_help=False,
+    )
+
+    standard_threads = min(multiprocessing.cpu_count(), 128)
+
+    reqs = parser.add_argument_group("Required arguments")
+
+    reqs.add_argument(
+        "--samplesheet",
+        "-s",
+        type=checkfile,
+        metavar="File",
+        help="Tab separated sample sheet with the columns 'samplename', 'input' and 'output'\nThe optional columns 'variants', 'output-gff', 'depth-of-coverage' and 'index-override-report' give the other output files per sample",
+        required=True,
+    )
+
+    reqs.add_argument(
+        "--reference",
+        "-ref",
+        type=lambda fname: checkfasta(parser, fname),
+        metavar="File",
+        help="Reference Fasta file",
+        required=True,
+    )
+
+    reqs.add_argument(
+        "--features",
+        "-gff",
+        type=lambda fname: checkgff(parser, fname),
+        metavar="File",
+        help="File with genome features (GFF)",
+        required=True,
+    )
+
+    reqs.add_argument(
+        "--coverage-level",
+        "-cov",
+        type=int,
+        default=30,
+        metavar="100",
+        help="The minimum coverage level of the consensus and variant calls",
+        required=True,
+    )
+
+    opts = parser.add_argument_group("Optional arguments")
+
+    opts.add_argument(
+        "--summary",
+        type=str,
+        metavar="File",
+        help="Output TSV file with a summary line per sample\nWritten to standard output when not given",
+    )
+
+    opts.add_argument(
+        "--threads",
+        "-t",
+        default=standard_threads,
+        metavar="N",
+        help="Number of samples that are processed at the same time",
+        type=int,
+    )
+
+    opts.add_argument(
+        "--noambiguity",
+        "-noambig",
+        action="store_true",
+        help="Turn off ambiguity nucleotides in the generated consensus sequences",
+    )
+
+    opts.add_argument(
+        "--index-override",
+        type=checkfile,
+        metavar="File",
+        help="Override the positional index of certain genome positions for every sample, see TrueConsense -h",
+    )
+
+    AddCacheArguments(opts)
+
+    opts.add_argument(
+        "--version",
+        "-v",
+        action="version",
+        version=__version__,
+        help="Show the TrueConsense version and exit",
+    )
+
+    opts.add_argument(
+        "--help",
+        "-h",
+        action="help",
+        default=argparse.SUPPRESS,
+        help="Show this help message and exit",
+    )
+
+    args = parser.parse_args(givenargs)
+
+    return args
+
+
+def ReadSampleSheet(f):
+    """Reads the sample sheet and checks that the required columns are present
+
+    Parameters
+    ----------
+    f
+        the path of the tab separated sample sheet
+
+    Returns
+    -------
+        A list with a dictionary per sample, missing optional outputs are None.
+
+    """
+    sheet = pd.read_csv(f, sep="\t", dtype=str, comment="#").dropna(how="all")
+    missing = [c for c in SHEET_REQUIRED if c not in sheet.columns]
+    if missing:
+        print(
+            f"Sample sheet {color.YELLOW}({f}){color.END} is missing the column(s): {', '.join(missing)}. Exiting..."
+        )
+        sys.exit(1)
+    if sheet["samplename"].duplicated().any():
+        duplicates = sheet.loc[sheet["samplename"].duplicated(), "samplename"].unique()
+        print(
+            f"Sample sheet {color.YELLOW}({f}){color.END} has duplicate sample names: {', '.join(duplicates)}. Exiting..."
+        )
+        sys.exit(1)
+    for c in SHEET_OPTIONAL:
+        if c not in sheet.columns:
+            sheet[c] = None
+    sheet = sheet.astype(object).where(sheet.notna(), None)
+    return sheet[SHEET_REQUIRED + SHEET_OPTIONAL].to_dict("records")
+
+
+def _init_worker(shared):
+    """Makes the parsed reference and features available to a worker process"""
+    _shared.update(shared)
+
+
+def Summarise(sample, mincov, Indexes, consensus, report=None):
+    """Gives the summary line of a finished sample
+
+    Parameters
+    ----------
+    sample
+        the sample sheet entry of the sample
+    mincov
+        the minimum coverage
+    Indexes
+        the PileupIndex of the sample per reference sequence
+    consensus
+        the BuildConsensus results per reference sequence
+    report, optional
+        the report of the index override, see Override_index_positions
+
+    Returns
+    -------
+        A dictionary with the values of SUMMARY_COLUMNS.
+
+    """
+    sequence = "".join(c[0] for c in consensus.values()).upper()
+    coverage = np.concatenate([index.coverage for index in Indexes.values()])
+    return {
+        "samplename": sample["samplename"],
+        "status": "ok",
+        "contigs": len(consensus),
+        "length": len(sequence),
+        "N": sequence.count("N"),
+        # only the IUPAC ambiguity codes, N and deletions are counted separately
+        "ambiguous": sum(1 for n in sequence if n in "RYKMSWBDHV"),
+        "deletions": sequence.count("-"),
+        "mean_coverage": round(float(coverage.mean()), 2),
+        "breadth": round(float((coverage >= mincov).mean()), 4),
+        "overridden": "" if report is None else len(report),
+        "message": "",
+    }
+
+
+def _run_sample(sample):
+    """Processes a single sample of the sample sheet with the shared reference and features.
+    A failing sample doesn't stop the batch, the error is reported in its summary line instead.
+
+    Parameters
+    ----------
+    sample
+        the sample sheet entry of the sample
+
+    Returns
+    -------
+        A dictionary with the values of SUMMARY_COLUMNS.
+
+    """
+    try:
+        Indexes, consensus, report = ProcessSample(
+            sample["input"],
+            sample["samplename"],
+            _shared["reference"],
+            _shared["features"],
+            _shared["mincov"],
+            _shared["IncludeAmbig"],
+            sample["output"],
+            variants=sample["variants"],
+            output_gff=sample["output-gff"],
+            depth_of_coverage=sample["depth-of-coverage"],
+            override=_shared["override"],
+            threads=1,
+            references=_shared["references"],
+            cache=_shared["cache"],
+            override_report=sample["index-override-report"],
+        )
+    except Exception as e:
+        summary = dict.fromkeys(SUMMARY_COLUMNS, "")
+        summary.update(
+            samplename=sample["samplename"],
+            status="failed",
+            message=f"{type(e).__name__}: {e}",
+        )
+        return summary
+    return Summarise(sample, _shared["mincov"], Indexes, consensus, report)
+
+
+def main(args: list[str] | None = None):
+    if not args:
+        args = sys.argv[1:]
+
+    if len(args) < 1:
+        print(
+            "TrueConsense-batch was called but no arguments were given, please try again.\nUse 'TrueConsense-batch -h' to see the help document"
+        )
+        sys.exit(1)
+    parsed_args = GetArgs(args)
+
+    samples = ReadSampleSheet(parsed_args.samplesheet)
+
+    shared = {
+        "reference": parsed_args.reference,
+        "references": ReadReference(parsed_args.reference),
+        "features": Gffindex(parsed_args.features),
+        "mincov": parsed_args.coverage_level,
+        "IncludeAmbig": not parsed_args.noambiguity,
+        "override": None,
+        "cache": CacheFromArgs(parsed_args),
+    }
+    if parsed_args.index_override:
+        shared["override"] = read_override_index(
+            parsed_args.index_override, shared["cache"]
+        )
+
+    workers = max(1, min(parsed_args.threads, len(samples)))
+    if workers < 2:
+        _init_worker(shared)
+        summaries = [_run_sample(sample) for sample in samples]
+    else:
+        with cf.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker, initargs=(shared,)
+        ) as xc:
+            summaries = list(xc.map(_run_sample, samples))
+
+    summary = pd.DataFrame(summaries, columns=SUMMARY_COLUMNS)
+    if parsed_args.summary is not None:
+        summary.to_csv(parsed_args.summary, sep="\t", index=False)
+    else:
+        summary.to_csv(sys.stdout, sep="\t", index=False)
+
+    failed = summary[summary["status"] == "failed"]
+    for _, row in failed.iterrows():
+        print(
+            f"{color.RED}{row['samplename']}{color.END}: {row['message']}",
+            file=sys.stderr,
+        )
+    if len(failed) > 0:
+        sys.exit(1)
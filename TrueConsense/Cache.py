@@ -0,0 +1,370 @@
+"""
+On-disk cache of the pileup count matrices and insertion tables made by BuildIndex,
+and of the parsed index override tables
+"""
+
+import hashlib
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pysam
+
+# Bump this when the layout or the meaning of the cached count matrices changes,
+# older cache files then simply won't be found anymore and are pruned eventually
+CACHE_VERSION = 2
+
+# Temporary files older than this (in seconds) were left by a run that was killed
+# while it wrote to the cache, they are removed when the cache is pruned
+STALE_TEMPFILE_AGE = 3600
+
+
+def DefaultCacheDir():
+    """Gives the default location of the index cache, $TRUECONSENSE_CACHE or the user
+    cache directory
+
+    Returns
+    -------
+        The path of the cache directory.
+
+    """
+    if "TRUECONSENSE_CACHE" in os.environ:
+        return os.environ["TRUECONSENSE_CACHE"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(base, "TrueConsense")
+
+
+def AddCacheArguments(group):
+    """Adds the options of the index cache to an argument group of a command line parser
+
+    Parameters
+    ----------
+    group
+        an argparse argument group
+
+    """
+    group.add_argument(
+        "--index-cache",
+        type=str,
+        default=DefaultCacheDir(),
+        metavar="Dir",
+        help="Directory where the index of every bam file is cached, so running the same bam file again doesn't have to pile up all reads again\nDefaults to $TRUECONSENSE_CACHE or ~/.cache/TrueConsense",
+    )
+
+    group.add_argument(
+        "--index-cache-size",
+        type=int,
+        default=2048,
+        metavar="MB",
+        help="Maximum size of the index cache in megabytes, the least recently used indexes are removed when it grows larger",
+    )
+
+    group.add_argument(
+        "--no-index-cache",
+        action="store_true",
+        help="Don't read or write the index cache",
+    )
+
+    group.add_argument(
+        "--refresh-index-cache",
+        action="store_true",
+        help="Always pile up the reads again and replace the cached index",
+    )
+
+
+def CacheFromArgs(args):
+    """Gives the IndexCache described by the parsed command line options
+
+    Parameters
+    ----------
+    args
+        the parsed arguments, with the options of AddCacheArguments
+
+    Returns
+    -------
+        An IndexCache, or None if the cache is turned off.
+
+    """
+    if args.no_index_cache:
+        return None
+    return IndexCache(
+        args.index_cache,
+        maxsize=args.index_cache_size * 1024**2,
+        refresh=args.refresh_index_cache,
+    )
+
+
+def _unpack_insertions(positions, sizes, seqs, counts):
+    """Turns the flat arrays of a cached insertion table back into the dictionary made
+    by PileupCounts
+
+    Parameters
+    ----------
+    positions
+        the positions with insertions
+    sizes
+        the number of different inserted sequences per position
+    seqs
+        the inserted sequences of all positions after each other
+    counts
+        the number of reads of every inserted sequence
+
+    Returns
+    -------
+        A dictionary with the inserted sequences and their number of reads per position.
+
+    """
+    table = {}
+    bounds = np.concatenate(([0], np.cumsum(sizes)))
+    for p, s, e in zip(positions.tolist(), bounds[:-1].tolist(), bounds[1:].tolist()):
+        table[p] = dict(zip(seqs[s:e].tolist(), counts[s:e].tolist()))
+    return table
+
+
+class IndexCache:
+    """A directory with count matrices of earlier runs, one .npz file per bam file and
+    reference. Parsed index override tables are kept in the same directory, one .npz
+    file per override file.
+
+    Entries are keyed on the size, modification time and header of the bam file and on
+    the sequences of the reference, so a changed bam file or reference is piled up
+    again. The least recently used entries are removed when the directory grows beyond
+    maxsize bytes.
+    """
+
+    def __init__(self, directory, maxsize=2 * 1024**3, refresh=False):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.refresh = refresh
+
+    def key(self, bamfile, ref, lengths, region=None):
+        """Gives the cache key of a bam file and a reference, or of a region of it
+
+        Parameters
+        ----------
+        bamfile
+            the path to the bam file
+        ref
+            the path to the reference fasta
+        lengths
+            the length of every reference sequence
+        region, optional
+            the (contig, start, end) tuple of a region, see ParseRegion
+
+        Returns
+        -------
+            A hexadecimal string.
+
+        """
+        h = hashlib.sha256(f"TrueConsense-index-v{CACHE_VERSION}".encode())
+        for f in (bamfile, ref):
+            st = os.stat(f)
+            h.update(f"{st.st_size}:{st.st_mtime_ns};".encode())
+        with pysam.AlignmentFile(bamfile, "rb") as bam:
+            h.update(str(bam.header).encode())
+        for contig, length in lengths.items():
+            h.update(f"{contig}:{length};".encode())
+        if region is not None:
+            h.update("region {}:{}-{};".format(*region).encode())
+        return h.hexdigest()
+
+    def file_key(self, f, kind):
+        """Gives the cache key of the parsed contents of a single input file
+
+        Parameters
+        ----------
+        f
+            the path to the file
+        kind
+            what the file holds, files of another kind never share a key
+
+        Returns
+        -------
+            A hexadecimal string.
+
+        """
+        h = hashlib.sha256(f"TrueConsense-{kind}-v{CACHE_VERSION}".encode())
+        st = os.stat(f)
+        h.update(f"{os.path.abspath(f)}:{st.st_size}:{st.st_mtime_ns};".encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def load_arrays(self, key):
+        """Loads all arrays of a cache entry
+
+        Parameters
+        ----------
+        key
+            the cache key
+
+        Returns
+        -------
+            A dictionary with the arrays of the entry, or None if there is no (readable)
+            entry.
+
+        """
+        if self.refresh:
+            return None
+        f = self.path(key)
+        try:
+            with np.load(f) as data:
+                arrays = {k: data[k] for k in data.files}
+        except (OSError, KeyError, ValueError):
+            return None
+        try:
+            os.utime(f)
+        except OSError:
+            pass
+        return arrays
+
+    def load(self, key, lengths):
+        """Loads the count matrices and insertion tables of a cache entry
+
+        Parameters
+        ----------
+        key
+            the cache key, see IndexCache.key
+        lengths
+            the length of every reference sequence, an entry that doesn't match these
+            isn't used
+
+        Returns
+        -------
+            A dictionary with the count matrix and a dictionary with the insertion table
+            per reference sequence, or None if there is no (usable) entry.
+
+        """
+        if self.refresh:
+            return None
+        f = self.path(key)
+        try:
+            with np.load(f) as data:
+                contigs = list(data["contigs"])
+                if contigs != list(lengths):
+                    return None
+                counts = {
+                    c: data[f"counts_{i}"].astype(np.int64)
+                    for i, c in enumerate(contigs)
+                }
+                insertions = {
+                    c: _unpack_insertions(
+                        data[f"ins_pos_{i}"],
+                        data[f"ins_n_{i}"],
+                        data[f"ins_seq_{i}"],
+                        data[f"ins_count_{i}"],
+                    )
+                    for i, c in enumerate(contigs)
+                }
+        except (OSError, KeyError, ValueError):
+            return None
+        if any(len(counts[c]) != l for c, l in lengths.items()):
+            return None
+        # the modification time marks when an entry was last used
+        try:
+            os.utime(f)
+        except OSError:
+            pass
+        return counts, insertions
+
+    def save(self, key, counts, insertions):
+        """Writes the count matrices and insertion tables to the cache and removes the
+        least recently used entries when the cache has grown too large. A cache that
+        can't be written only gives a warning.
+
+        Parameters
+        ----------
+        key
+            the cache key, see IndexCache.key
+        counts
+            a dictionary with the count matrix per reference sequence
+        insertions
+            a dictionary with the insertion table per reference sequence
+
+        """
+        arrays = {"contigs": np.array(list(counts), dtype=str)}
+        for i, (contig, c) in enumerate(counts.items()):
+            # counts that fit are stored as 32 bit integers, which halves the size of
+            # the cache
+            if c.size == 0 or c.max() <= np.iinfo(np.int32).max:
+                c = c.astype(np.int32)
+            arrays[f"counts_{i}"] = c
+            table = insertions[contig]
+            arrays[f"ins_pos_{i}"] = np.array(list(table), dtype=np.int64)
+            arrays[f"ins_n_{i}"] = np.array(
+                [len(v) for v in table.values()], dtype=np.int64
+            )
+            arrays[f"ins_seq_{i}"] = np.array(
+                [seq for v in table.values() for seq in v], dtype=str
+            )
+            arrays[f"ins_count_{i}"] = np.array(
+                [n for v in table.values() for n in v.values()], dtype=np.int64
+            )
+        self.save_arrays(key, arrays)
+
+    def save_arrays(self, key, arrays):
+        """Writes a dictionary of arrays to the cache and removes the least recently
+        used entries when the cache has grown too large. A cache that can't be written
+        only gives a warning.
+
+        Parameters
+        ----------
+        key
+            the cache key
+        arrays
+            a dictionary with the arrays that are stored under their name
+
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # written under a temporary name first, so parallel runs never read a half
+            # written file
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".npz.tmp")
+            try:
+                with os.fdopen(fd, "wb") as out:
+                    np.savez(out, **arrays)
+                os.replace(tmp, self.path(key))
+            except OSError:
+                os.remove(tmp)
+                raise
+        except OSError as e:
+            print(
+                f"Could not write the index cache to {self.directory}: {e}",
+                file=sys.stderr,
+            )
+            return
+        self.prune()
+
+    def prune(self):
+        """Removes the temporary files of killed runs and the least recently used
+        entries until the cache fits in maxsize bytes"""
+        entries = []
+        stale = time.time() - STALE_TEMPFILE_AGE
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith((".npz", ".npz.tmp")):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            if entry.name.endswith(".npz"):
+                entries.append((st.st_mtime, st.st_size, entry.path))
+            elif st.st_mtime < stale:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+        total = sum(size for _, size, _ in entries)
+        for _, size, f in sorted(entries):
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(f)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -1,34 +1,143 @@
-def BuildCoverage(iDict, output):
-    """This function takes a dictionary of dictionaries and an output file name as input, and writes the
-    coverage of each position to the output file.
+import numpy as np
+import pysam
+
+# number of positions that are formatted at once when writing text output
+_CHUNK = 1 << 16
+
+
+def _format_columns(template, columns):
+    """Formats the rows of a few integer columns in bulk, one line per row.
 
     Parameters
     ----------
-    iDict
-        a dictionary of with pileup contents per position
-    output
-        the name of the output file
+    template
+        the %-template of a single line
+    columns
+        a list of equally long integer arrays, one per field of the template
+
+    Returns
+    -------
+        The formatted lines as a single string.
 
     """
-    with open(output, "w") as outfile:
-        for i in range(len(iDict)):
-            cov = iDict[i + 1].get("coverage")
-            outfile.write(str(i + 1) + "\t" + str(cov) + "\n")
+    interleaved = np.empty(len(columns[0]) * len(columns), dtype=np.int64)
+    for i, c in enumerate(columns):
+        interleaved[i :: len(columns)] = c
+    return (template * len(columns[0])) % tuple(interleaved.tolist())
 
 
-def GetCoverage(iDict, position):
-    """Takes a dictionary and a position as input, and returns the coverage of that position
+def _coverage_runs(coverage):
+    """Gives the stretches of positions with the same coverage.
 
     Parameters
     ----------
-    iDict
-        A dictionary with pileup contents per position
-    position
-        the position in the genome that you want to get the coverage for
+    coverage
+        the coverage array of a reference sequence
 
     Returns
     -------
-        The coverage of the position.
+        The 0-based start, exclusive end and coverage of every stretch.
 
     """
-    return iDict[position].get("coverage")
+    if len(coverage) == 0:
+        return coverage, coverage, coverage
+    starts = np.flatnonzero(np.diff(coverage, prepend=coverage[0] - 1))
+    ends = np.append(starts[1:], len(coverage))
+    return starts, ends, coverage[starts]
+
+
+def WriteBinaryCoverage(coverages, output):
+    """Writes the coverage of every reference sequence as an uint32 array to an
+    (uncompressed) .npz file, with an array per reference sequence named after it.
+    Element p - 1 of an array belongs to position p.
+
+    Parameters
+    ----------
+    coverages
+        a dictionary with the coverage array of every reference sequence
+    output
+        the name of the output file
+
+    """
+    arrays = {
+        contig: np.minimum(coverage, np.iinfo(np.uint32).max).astype(np.uint32)
+        for contig, coverage in coverages.items()
+    }
+    with open(output, "wb") as outfile:
+        np.savez(outfile, **arrays)
+
+
+def BuildCoverage(coverages, output, start=0):
+    """This function takes the coverage array per reference sequence and an output file
+    name as input, and writes the coverage of each position to the output file.
+    The format follows from the name of the output file:
+    .npz gives an uint32 array per reference sequence (see WriteBinaryCoverage),
+    .bedgraph or .bg gives bedGraph lines for every stretch of positions with the same
+    coverage, anything else gives a TSV with the coverage of every position.
+    With multiple reference sequences the name of the sequence is written as the first
+    column of the TSV. Text output that ends with .gz is bgzip-compressed and indexed
+    with tabix, the TSV then always gets the name of the reference sequence as its
+    first column.
+
+    Parameters
+    ----------
+    coverages
+        a dictionary with the coverage array of every reference sequence, element p - 1
+        belongs to position p
+    output
+        the name of the output file
+    start, optional
+        the 0-based position on the reference sequence of the first position of the
+        index, when the index only has a region of it. The positions of the text output
+        are counted from the start of the reference sequence, the .npz arrays only hold
+        the region
+
+    """
+    name = output.lower()
+    if name.endswith(".npz"):
+        WriteBinaryCoverage(coverages, output)
+        return
+
+    compressed = name.endswith(".gz")
+    bedgraph = name.removesuffix(".gz").endswith((".bedgraph", ".bg"))
+
+    if compressed:
+        outfile = pysam.BGZFile(output, "wb")
+        write = lambda text: outfile.write(text.encode())
+    else:
+        outfile = open(output, "w", buffering=1024**2)
+        write = outfile.write
+
+    with outfile:
+        for contig, coverage in coverages.items():
+            if bedgraph:
+                starts, ends, values = _coverage_runs(coverage)
+                prefix = contig.replace("%", "%%")
+                for s in range(0, len(starts), _CHUNK):
+                    write(
+                        _format_columns(
+                            f"{prefix}\t%d\t%d\t%d\n",
+                            [
+                                starts[s : s + _CHUNK] + start,
+                                ends[s : s + _CHUNK] + start,
+                                values[s : s + _CHUNK],
+                            ],
+                        )
+                    )
+                continue
+
+            prefix = "" if len(coverages) == 1 and not compressed else f"{contig}\t"
+            prefix = prefix.replace("%", "%%")
+            for s in range(0, len(coverage), _CHUNK):
+                positions = np.arange(s + 1, min(s + _CHUNK, len(coverage)) + 1) + start
+                write(
+                    _format_columns(
+                        f"{prefix}%d\t%d\n", [positions, coverage[s : s + _CHUNK]]
+                    )
+                )
+
+    if compressed:
+        if bedgraph:
+            pysam.tabix_index(output, preset="bed", force=True)
+        else:
+            pysam.tabix_index(output, seq_col=0, start_col=1, end_col=1, force=True)
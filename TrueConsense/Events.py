@@ -1,19 +1,18 @@
-import re
-from collections import Counter
+import numpy as np
 
 
-def ListInserts(iDict, mincov, bam):
-    """This function takes a dictionary pileup contents, a minimum coverage value, and a bam file.
+def ListInserts(index, mincov, alleles):
+    """This function takes the pileup index, a minimum coverage value, and the insertion allele table.
     returns a boolean and a dictionary of insert positions.
 
     Parameters
     ----------
-    iDict
-        This is the dictionary that contains pileup information including coverage and insertions for each position.
+    index
+        the PileupIndex with the coverage and the number of insertions for each position.
     mincov
         minimum coverage to take into account
-    bam
-        the bam file
+    alleles
+        the insertion allele table made by BuildIndex
 
     Returns
     -------
@@ -21,86 +20,66 @@ def ListInserts(iDict, mincov, bam):
 
     """
     positions = {}
+    inserts = ExtractInserts(alleles)
 
-    for k in iDict.keys():
-        cov = iDict[k].get("coverage")
-        ins = iDict[k].get("I")
-
-        if cov < mincov:
-            continue
-        if cov == 0 or ins == 0:
-            continue
-        if cov == 0 and ins == 0:
-            continue
+    cov = index.coverage
+    ins = index.column("I")
+    candidates = (cov >= mincov) & (cov > 0) & (ins > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
         perc = (ins / cov) * 100
-        if perc > 55:
-            InsNuc, insertsize = ExtractInserts(bam, k)
-            if InsNuc is None or insertsize is None:
-                continue
-            positions[k] = {}
-            positions[k][insertsize] = InsNuc
+    for k in (np.flatnonzero(candidates & (perc > 55)) + 1).tolist():
+        if k not in inserts:
+            continue
+        InsNuc, insertsize = inserts[k]
+        positions[k] = {}
+        positions[k][insertsize] = InsNuc
     if not positions:
         return False, None
     return True, positions
 
 
-def ExtractInserts(bam, position):
-    """It takes a bam file and a position and returns the most common insert sequence and the size of the
-    insert
+def ExtractInserts(alleles):
+    """It takes the insertion allele table and returns the most common insert sequence and the size of the
+    insert per position
 
     Parameters
     ----------
-    bam
-        the bam file
-    position
-        the position in the reference genome to extract
+    alleles
+        the insertion allele table made by BuildIndex, sorted on position and count
 
     Returns
     -------
-        the most common insert sequence and the size of the insert.
+        A dictionary with the most common insert sequence and the size of the insert per position.
 
     """
-    rname = bam.references[0]
-    start = position - 1
-    end = position
-    for pileupcolumn in bam.pileup(rname, start, end, truncate=True):
-        items = pileupcolumn.get_query_sequences(add_indels=True)
-        found = []
-        if bool(items) is False:
-            return None, None
-        for i in items:
-            found.append(i.upper())
-        sorteddist = dict(Counter(found).most_common())
-        a = next(iter(sorteddist))
-        match = re.search("(\d)([a-zA-Z]+)", a)
-
-        if match:
-            bases = match.group(2)
-            insertsize = match.group(1)
-            return bases, insertsize
-        return None, None
-    return None, None
-
-
-def MinorityDel(index, p):
-    """If the percentage of deletions on a position is greater than 15%, then return True
+    top = alleles.drop_duplicates("position")
+    return dict(
+        zip(
+            top["position"].tolist(),
+            zip(top["sequence"].tolist(), top["length"].tolist()),
+        )
+    )
+
+
+# percentage of deletions from which a position counts as a minority deletion
+MINORITY_DELETION = 15
+
+
+def MinorityDeletions(index):
+    """Marks the positions where the percentage of deletions is at least MINORITY_DELETION,
+    positions without coverage are never minority deletions
 
     Parameters
     ----------
     index
-        The dictionary with pileup contents per position
-    p
-        position in the genome
+        The PileupIndex of the reference sequence
 
     Returns
     -------
-        True or False
+        A boolean array, element p - 1 belongs to position p.
 
     """
-    cov = index[p].get("coverage")
-    dels = index[p].get("X")
-    perc = (dels / cov) * 100
-
-    if perc >= 15:
-        return True
-    return False
+    cov = index.coverage
+    dels = index.column("X")
+    perc = (dels / np.where(cov == 0, 1, cov)) * 100
+    return (cov > 0) & (perc >= MINORITY_DELETION)
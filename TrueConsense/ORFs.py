@@ -1,45 +1,83 @@
-def in_orf(loc, gffd):
-    """If the location is in any of the ORFs, return True. Otherwise, return False
+import bisect
+
+
+class FeatureIndex:
+    """Sorted-array index of the genome positions that are covered by the features of a
+    gff dictionary. The genome is divided in segments at every feature boundary, each
+    segment holds the features that cover it, so the features that cover a position are
+    found with a single binary search instead of scanning all features.
 
     Parameters
     ----------
-    loc
-        the current position
-    gffd
+    gffdict
         a dictionary of dictionaries, where the keys are the gene IDs, and the values are dictionaries containing the gene attributes
 
-    Returns
-    -------
-        A list of True/False values.
-
     """
-    exists = []
-    for k in gffd.keys():
-        start = gffd[k].get("start")
-        stop = gffd[k].get("end")
 
-        xx = loc in range(start, stop)
-        exists.append(xx)
+    def __init__(self, gffdict):
+        order = {k: i for i, k in enumerate(gffdict.keys())}
+        events = {}
+        for k in gffdict.keys():
+            if gffdict[k].get("end") < gffdict[k].get("start"):
+                continue
+            # feature ends are inclusive, so the feature is left at end + 1
+            events.setdefault(gffdict[k].get("start"), []).append((k, True))
+            events.setdefault(gffdict[k].get("end") + 1, []).append((k, False))
+
+        self.bounds = sorted(events)
+        self.segments = []
+        active = set()
+        for b in self.bounds:
+            for k, entering in events[b]:
+                if entering:
+                    active.add(k)
+                else:
+                    active.discard(k)
+            # features are kept in the order of the gff dictionary
+            self.segments.append(tuple(sorted(active, key=order.get)))
 
-    if any(exists) == True:
-        return True
-    return False
+    def at(self, p):
+        """Returns the features that cover position p
 
+        Parameters
+        ----------
+        p
+            position in the genome
 
-def split_to_codons(seq):
-    """It takes a string of DNA and returns a list of codons (nucleotide triplets)
+        Returns
+        -------
+            A tuple of the keys of the features that cover position p, in the order of
+            the gff dictionary.
+
+        """
+        i = bisect.bisect_right(self.bounds, p) - 1
+        if i < 0:
+            return ()
+        return self.segments[i]
+
+
+def in_orf(loc, table, features):
+    """If the location is in any of the ORFs, return True. Otherwise, return False
 
     Parameters
     ----------
-    seq
-        the sequence to split
+    loc
+        the current position
+    table
+        the FeatureTable with the corrected start and end positions of the features
+    features
+        the FeatureIndex of the original gff features, the features in the table can
+        only have shrunk compared to these
 
     Returns
     -------
-        A list of codons
+        A list of True/False values.
 
     """
-    return [seq[start : start + 3] for start in range(0, len(seq), 3)]
+    for k in features.at(loc):
+        if table.start(k) <= loc < table.ends[k]:
+            return True
+    return False
 
 
 def SolveTripletLength(uds, mds):
@@ -77,116 +115,229 @@ def SolveTripletLength(uds, mds):
         return False
 
 
-def CorrectStartPositions(gffd, shifts, p):
-    """Function takes a dictionary of gff data, a list of shifts, and a position. It then iterates
-    through the dictionary and updates the start position of each entry if the start position is greater
-    than the position
+class ReadingFrame:
+    """Running state of a single (forward strand) ORF while the consensus sequence
+    grows. Only the characters that were appended since the previous update are read, so
+    following an ORF costs O(1) per appended base instead of re-reading the ORF from its
+    start.
 
     Parameters
     ----------
-    gffd
-        a dictionary of dictionaries, where each key is a gene name, and each value is a dictionary of the
-        gene's attributes
-    shifts
-        the number of bases to shift the start positions by
-    p
-        the position of the first base of the insertion
-
-    Returns
-    -------
-        A dictionary with the updated start positions.
+    anchor
+        index in the consensus sequence of the first nucleotide of the ORF
 
     """
-    for k in gffd.keys():
-        start = gffd[k].get("start")
-
-        if start > p:
-            nstart = int(start) + int(shifts)
-            update = {"start": nstart}
-
-            gffd[k].update(update)
-    return gffd
 
-
-def CorrectGFF(oldgffdict, newgffdict, cons, p, inserts, mincov, cov):
-    """This function corrects the start and end positions of the genes in the new GFF file
+    __slots__ = ("consumed", "gaps", "bases", "codon", "codons", "stop")
+
+    stopcodons = ("TAG", "TAA", "TGA")
+
+    def __init__(self, anchor):
+        self.consumed = anchor  # index of the next consensus character to read
+        self.gaps = 0  # number of deletions ('-') in the ORF
+        self.bases = 0  # number of non-deletion characters in the ORF
+        self.codon = ""  # partial codon that is being filled
+        self.codons = 0  # number of complete codons
+        self.stop = None  # codon number of the first stop codon
+
+    def extend(self, seq):
+        """Reads the characters of the consensus sequence that were appended since the
+        previous call
+
+        Parameters
+        ----------
+        seq
+            the flattened consensus sequence, as a list of characters
+
+        """
+        for c in seq[self.consumed :]:
+            if c == "-":
+                self.gaps += 1
+                continue
+            self.bases += 1
+            if self.stop is not None:
+                continue
+            self.codon += c
+            if len(self.codon) == 3:
+                self.codons += 1
+                if self.codon in self.stopcodons:
+                    self.stop = self.codons
+                self.codon = ""
+        self.consumed = len(seq)
+
+    def end(self, start):
+        """Calculates where the ORF ends with the consensus sequence read so far, if no
+        stop codon was found this lies just beyond the current end of the ORF.
+
+        Parameters
+        ----------
+        start
+            the start position of the ORF
+
+        Returns
+        -------
+            The end position of the ORF.
+
+        """
+        if self.stop is not None:
+            return start + self.stop * 3 + self.gaps - 1
+        codons = self.codons + (1 if self.codon else 0)
+        return start + codons * 3 + self.gaps
+
+
+class FeatureTable:
+    """Columns with the start, end and strand of the features of a gff dictionary, which
+    are corrected while the consensus sequence is being built. The rows of the gff
+    dictionary itself are left untouched.
+
+    An insertion shifts the start of every feature that starts after it. Instead of
+    updating every feature, the total size of the insertions is kept as a single offset.
+    The starts of the features that were passed by an insertion are frozen, these always
+    form a prefix of the features sorted on their original start, so every insertion
+    only has to look at the features that are frozen by it.
 
     Parameters
     ----------
-    oldgffdict
-        a dictionary of the old gff file
-    newgffdict
-        the new gff dictionary
-    cons
-        the consensus sequence
-    p
-        the position of the current base
-    inserts
-        a dictionary of insertions, where the key is the position of the insertion and the value is the
-    nucleotide inserted
-    mincov
-        minimum coverage to consider a position as a potential insertion
-    cov
-        coverage of the contig
-
-    Returns
-    -------
-        A dictionary of the corrected gff file.
+    gffdict
+        a dictionary of dictionaries, where the keys are the gene IDs, and the values
+        are dictionaries containing the gene attributes
 
     """
 
-    stopcodons = ["TAG", "TAA", "TGA"]
-    # rvstopcodon = ["CAT"]
-
-    if inserts is not None and p in inserts:
-        if cov > mincov:
-            newgffdict = CorrectStartPositions(
-                newgffdict, list(inserts[p].keys())[0], p
-            )
-
-    for k in newgffdict.keys():
-        start = newgffdict[k].get("start")
-        end = newgffdict[k].get("end")
-        orient = newgffdict[k].get("strand")
-
-        shift = 0
-
-        if p in range(start, end):
-            if orient == "+":
-                rseq = "".join(cons)[start - 1 :]
-                shift = rseq.count("-")
-                seq = rseq.replace("-", "")
+    def __init__(self, gffdict):
+        self.rows = gffdict
+        self.starts = {k: gffdict[k].get("start") for k in gffdict.keys()}
+        self.ends = {k: gffdict[k].get("end") for k in gffdict.keys()}
+        self.strands = {k: gffdict[k].get("strand") for k in gffdict.keys()}
+        self.offset = 0  # total size of the insertions so far
+        self.frozen = {}  # start positions that no longer shift, per feature
+        self.order = sorted(self.starts, key=self.starts.get)
+        self.passed = 0  # number of features in self.order that are frozen
+
+    def start(self, k):
+        """Returns the current start position of feature k
+
+        Parameters
+        ----------
+        k
+            the key of the feature in the gff dictionary
+
+        Returns
+        -------
+            The start position, including the shifts of the insertions before it.
+
+        """
+        start = self.frozen.get(k)
+        if start is None:
+            return self.starts[k] + self.offset
+        return start
+
+    def shift(self, p, size):
+        """Shifts the start positions of the features that start after an insertion.
+
+        Parameters
+        ----------
+        p
+            the position of the first base of the insertion
+        size
+            the number of bases to shift the start positions by
+
+        """
+        order, starts = self.order, self.starts
+        while (
+            self.passed < len(order) and starts[order[self.passed]] + self.offset <= p
+        ):
+            k = order[self.passed]
+            self.frozen[k] = starts[k] + self.offset
+            self.passed += 1
+        self.offset += int(size)
+
+    def to_dict(self):
+        """Gives the corrected gff dictionary. Only the features with a changed start or
+        end are copied, the others are the rows of the original gff dictionary.
+
+        Returns
+        -------
+            A dictionary of the corrected gff file.
+
+        """
+        corrected = {}
+        for k, row in self.rows.items():
+            start, end = self.start(k), self.ends[k]
+            if start != row.get("start") or end != row.get("end"):
+                row = dict(row)
+                row["start"] = start
+                row["end"] = end
+            corrected[k] = row
+        return corrected
+
+
+class ORFTracker:
+    """This class corrects the start and end positions of the genes in the new GFF file
+    while the consensus sequence is being built, one position at a time.
 
-                if cons[-1] == "-":
-                    achieved = False
-                    override_end = oldgffdict[k].get("end")
-                    up = {"end": override_end}
-                    newgffdict[k].update(up)
-
-                else:
-
-                    codons = split_to_codons(seq)
-
-                    achieved = False
-
-                    it = 0
-                    for c in codons:
-                        it += 1
-                        if any(s in c for s in stopcodons) is True:
-                            achieved = True
-                            break
-                    orfsize = it * 3
-
-                    if shift % 3 == 0:
-                        newend = start + orfsize + shift - 1
-                    else:
-                        newend = start + orfsize + shift - 1
-
-                    if achieved is False:
-                        newend = newend + 1
+    Parameters
+    ----------
+    table
+        the FeatureTable of the old gff file, which is updated in place
+    features
+        the FeatureIndex of the old gff file
 
-                    if p == newend:
-                        up = {"end": newend}
-                        newgffdict[k].update(up)
+    """
 
-    return newgffdict
+    def __init__(self, table, features):
+        self.table = table
+        self.features = features
+        self.seq = []  # the consensus sequence so far, one character per item
+        self.items = 0  # number of items of the consensus list that are in self.seq
+        self.frames = {}
+
+    def update(self, cons, p, inserts, mincov, cov):
+        """Updates the gff features after the consensus of position p was appended
+
+        Parameters
+        ----------
+        cons
+            the consensus sequence, as a list of (groups of) characters
+        p
+            the position of the current base
+        inserts
+            a dictionary of insertions, where the key is the position of the insertion
+            and the value is the nucleotide inserted
+        mincov
+            minimum coverage to consider a position as a potential insertion
+        cov
+            coverage of the contig
+
+        """
+        for item in cons[self.items :]:
+            self.seq.extend(item)
+        self.items = len(cons)
+
+        table = self.table
+        if inserts is not None and p in inserts:
+            if cov > mincov:
+                table.shift(p, list(inserts[p].keys())[0])
+
+        # Features only shrink while they are corrected, so the features that cover p in
+        # the old gff file are the only candidates
+        for k in self.features.at(p):
+            start = table.start(k)
+            end = table.ends[k]
+            orient = table.strands[k]
+
+            if orient != "+" or not start <= p < end:
+                continue
+
+            # The start of an ORF can't shift anymore once the ORF is reached
+            frame = self.frames.get(k)
+            if frame is None:
+                frame = self.frames[k] = ReadingFrame(start - 1)
+            frame.extend(self.seq)
+
+            if cons[-1] == "-":
+                table.ends[k] = table.rows[k].get("end")
+            else:
+                newend = frame.end(start)
+                if p == newend:
+                    table.ends[k] = newend
@@ -1,15 +1,86 @@
+import concurrent.futures as cf
+import functools
 import os
 import sys
 from datetime import date
 
-from Bio import SeqIO
+import numpy as np
+import pysam
 
-from .Coverage import GetCoverage
-from .Events import ListInserts
-from .indexing import Readbam
+from .Coverage import BuildCoverage
+from .indexing import ReadReference
 from .Sequences import BuildConsensus
 from AminoExtract.gff_data import GFFColumns
 
+
+@functools.lru_cache(maxsize=None)
+def _gff_layout(keys):
+    """Works out which values of a gff row are written to the GFF columns and which are
+    combined into the attributes column. This only depends on the keys of the row, so it
+    is done once per annotation.
+
+    Parameters
+    ----------
+    keys
+        a tuple with the keys of a row of the gff dictionary
+
+    Returns
+    -------
+        The indices in the row of the values of the GFF columns (except attributes), and
+        the lower-cased names and the indices of the values that are combined into the
+        attributes.
+
+    """
+    cols = GFFColumns.get_names()
+    cols_without_attr = [col for col in cols if col != "attributes"]
+
+    # keys that are the same when lower-cased are written once, with the last value
+    columns = {}
+    attributes = {}
+    for i, k in enumerate(keys):
+        name = str(k).lower()
+        if name not in cols_without_attr:
+            attributes[name] = i
+        else:
+            columns[name] = i
+    assert list(columns) + ["attributes"] == cols
+    return tuple(columns.values()), tuple(attributes), tuple(attributes.values())
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _gff_attributes(names, values):
+    """Combines the attributes column and the additional columns of a gff row into a
+    single attributes string. The attributes column is split into its attributes, the
+    additional columns are added as attributes and an attribute that is given more than
+    once keeps its first place with its last value. The attributes don't change between
+    samples, so they are only combined once.
+
+    Parameters
+    ----------
+    names
+        the lower-cased names of the values, see _gff_layout
+    values
+        the values as strings
+
+    Returns
+    -------
+        The attributes string.
+
+    """
+    attribute_dict = {}
+    for k, v in zip(names, values):
+        if k == "attributes":
+            for attribute in v.split(";"):
+                if attribute == "":
+                    continue
+                key, value = attribute.split("=")
+                attribute_dict[key] = value
+        else:
+            attribute_dict[k] = v
+
+    return ";".join(f"{k}={v}" for k, v in attribute_dict.items())
+
+
 def WriteGFF(gffheader, gffdict, output_gff, name):
     """Function takes a GFF header, a dictionary of GFF features, an output directory, and a name for
     the output file, and writes the GFF header and the GFF features to a file in the output directory
@@ -26,56 +97,257 @@ def WriteGFF(gffheader, gffdict, output_gff, name):
         the name of the file you want to write
 
     """
-    cols = GFFColumns.get_names()
-    cols_without_attr = [col for col in cols if col != "attributes"]
-
-    def combine_dict_into_attributes(input_dict: dict[str, str]) -> str:
-        attribute_dict = {}
-        for k, v in input_dict.items():
-            if k == "attributes":
-                for attribute in v.split(";"):
-                    if attribute == "":
-                        continue
-                    key, value = attribute.split("=")
-                    attribute_dict[key] = value
-            else:
-                attribute_dict[k] = v
-
-        return ";".join(f"{k}={v}" for k, v in attribute_dict.items())
-
-    def clean_dict(input_dict: dict[str, str]) -> dict[str, str]:
-        clean_dict = {}
-        attribute_dict = {}
-        for k, v in input_dict.items():
-            if str(k).lower() not in cols_without_attr:
-                attribute_dict[str(k).lower()] = str(v)
-            else:
-                clean_dict[str(k).lower()] = str(v)
-
-        attribute_str = combine_dict_into_attributes(attribute_dict)
-        clean_dict["attributes"] = attribute_str
-        assert list(clean_dict.keys()) == cols
-        return clean_dict
-
-
     # the gffdict will have 0, 1, 2, etc as keys, for each line in the GFF file
     # the values will be dictionaries containing the GFF columns for that line, with a lot of additional columns
     # these additional columns will all be forced into the attributes column
+    lines = [gffheader.raw_text]
+    keys = None
+    for gff_data in gffdict.values():
+        row_keys = tuple(gff_data)
+        if row_keys != keys:
+            keys = row_keys
+            columns, names, attributes = _gff_layout(keys)
+        values = list(gff_data.values())
+        fields = [str(values[i]) for i in columns]
+        fields.append(
+            _gff_attributes(names, tuple([str(values[i]) for i in attributes]))
+        )
+        lines.append("\t".join(fields) + "\n")
 
     with open(output_gff, "w") as out:
-        out.write(gffheader.raw_text)
+        out.write("".join(lines))
+
+
+def RecordName(name, contig, contigs):
+    """Gives the name of the output record of a reference sequence, with a single
+    reference sequence this is just the samplename. With multiple (segmented genomes)
+    the name of the sequence is added.
+
+    Parameters
+    ----------
+    name
+        the samplename
+    contig
+        the name of the reference sequence
+    contigs
+        the names of all sequences in the reference
+
+    Returns
+    -------
+        The name of the record.
+
+    """
+    if len(contigs) == 1:
+        return name
+    return f"{name}_{contig}"
+
 
+def VariantRecords(
+    refID, reference, consensus_noinsert, insertpositions, coverage, mincov, start=0
+):
+    """Finds the differences between a reference sequence and its consensus (without
+    inserts) with a vectorised comparison, and gives the VCF records of these
+    differences and of the called insertions.
+
+    Stretches of deletions are merged into a single record, anchored on the position
+    before the deletion. Insertions follow the record of the position they are called
+    on, insertions within a deletion are left out.
+
+    Parameters
+    ----------
+    refID
+        the name of the reference sequence
+    reference
+        the reference sequence, as bytes
+    consensus_noinsert
+        the consensus sequence without the insertions, as long as the reference
+    insertpositions
+        the dictionary of called insertions made by BuildConsensus, or None
+    coverage
+        the coverage array of the reference sequence, element p - 1 belongs to
+        position p
+    mincov
+        the minimum coverage
+    start, optional
+        the 0-based position on the reference sequence where the given (part of the)
+        reference starts, it is added to the positions of the records
+
+    Returns
+    -------
+        A list with the VCF records, as tab separated lines.
 
-        for line_number, gff_data in gffdict.items():
-            cleaned_data = clean_dict(gff_data)
-            out.write("\t".join([str(v) for v in cleaned_data.values()]) + "\n")
+    """
+    n = len(reference)
+    ref = np.frombuffer(reference, dtype=np.uint8)
+    seq = np.frombuffer(consensus_noinsert.upper().encode(), dtype=np.uint8)[:n]
+    gap = seq == ord("-")
+    snps = np.flatnonzero((ref != seq) & ~gap)
+
+    # every stretch of gaps is a single deletion, the rest of the stretch is skipped
+    edges = np.diff(gap.astype(np.int8), prepend=0, append=0)
+    delstarts = np.flatnonzero(edges == 1)
+    delends = np.flatnonzero(edges == -1)
+    skipped = gap.copy()
+    skipped[delstarts] = False
+
+    inserts = []
+    if insertpositions is not None:
+        # the keys of insertpositions are compared to the 0-based positions of the
+        # sequence, like before
+        inserts = [
+            i
+            for i in insertpositions
+            if i < n and not skipped[i] and coverage[i] > mincov
+        ]
+
+    # the record of a position (deletion or snp) comes before its insertion(s)
+    positions = np.concatenate(
+        (delstarts, snps, np.asarray(inserts, dtype=np.int64))
+    ).astype(np.int64)
+    kinds = np.repeat([0, 1, 2], [len(delstarts), len(snps), len(inserts)])
+    order = np.lexsort((kinds, positions))
+    delend = dict(zip(delstarts.tolist(), delends.tolist()))
+
+    records = []
+    for i, kind in zip(positions[order].tolist(), kinds[order].tolist()):
+        if kind == 0:
+            joinedreflist = chr(ref[i - 1]) + reference[i : delend[i]].decode()
+            records.append(
+                f"{refID}\t{i + start}\t.\t{joinedreflist}\t{chr(seq[i - 1])}\t.\tPASS\tDP={coverage[i]};INDEL\n"
+            )
+        elif kind == 1:
+            # the depth of the first two positions is taken from the second position
+            currentcov = coverage[max(i, 1)]
+            records.append(
+                f"{refID}\t{i + 1 + start}\t.\t{chr(ref[i])}\t{chr(seq[i])}\t.\tPASS\tDP={currentcov}\n"
+            )
+        else:
+            for y in insertpositions.get(i):
+                CombinedEntry = chr(seq[i]) + str(insertpositions.get(i).get(y))
+                records.append(
+                    f"{refID}\t{i + start}\t.\t{chr(ref[i])}\t{CombinedEntry}\t.\tPASS\tDP={coverage[i]};INDEL\n"
+                )
+    return records
+
+
+def WriteVCF(output_vcf, ref, mincov, coverages, calls, references=None, start=0):
+    """Writes the differences between the reference and the consensus sequences (without
+    inserts) and the called insertions to a VCF file. When the name of the VCF file ends
+    with .gz it is written bgzip-compressed and indexed with tabix, the records are then
+    sorted on their position as tabix requires.
+
+    Parameters
+    ----------
+    output_vcf
+        the path of the VCF file
+    ref
+        the path of the reference fasta
+    mincov
+        the minimum coverage
+    coverages
+        the coverage array of every reference sequence
+    calls
+        the consensus without insertions and the dictionary of insert positions (see
+        BuildConsensus) per reference sequence
+    references, optional
+        the Reference of the reference fasta, it is opened when it isn't given
+    start, optional
+        the 0-based position on the reference sequence of the first position of the
+        coverage, when it only covers a region of it
+
+    """
+    today = date.today().strftime("%Y%m%d")
+    if references is None:
+        references = ReadReference(ref)
+    contigs = list(coverages)
+    contiglines = "".join(f"##contig=<ID={refID}>\n" for refID in contigs)
+    compressed = output_vcf.endswith(".gz")
+
+    if compressed:
+        out = pysam.BGZFile(output_vcf, "wb")
+        write = lambda text: out.write(text.encode())
+    else:
+        out = open(output_vcf, "w", buffering=1024**2)
+        write = out.write
+
+    with out:
+        write(f"""##fileformat=VCFv4.3
+##fileDate={today}
+##source='TrueConsense {' '.join(sys.argv[1:])}'
+##reference='{ref}'
+{contiglines}##INFO=<ID=DP,Number=1,Type=Integer,Description="Read Depth">
+##INFO=<ID=INDEL,Number=0,Type=Flag,Description="Indicates that the variant is an INDEL.">
+#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO
+""")
+        # writecontents
+        for refID in contigs:
+            consensus_noinsert, insertpositions = calls[refID]
+            records = VariantRecords(
+                refID,
+                references.sequence(refID)[start : start + len(coverages[refID])],
+                consensus_noinsert,
+                insertpositions,
+                coverages[refID],
+                mincov,
+                start,
+            )
+            if compressed:
+                # insertions are written on the position before the snp on it
+                records.sort(key=lambda record: int(record.split("\t", 2)[1]))
+            write("".join(records))
+
+    if compressed:
+        pysam.tabix_index(output_vcf, preset="vcf", force=True)
+
+
+def WriteConsensus(output_consensus, name, mincov, contigs, sequences):
+    """Writes the consensus sequence of every reference sequence to a fasta file
+
+    Parameters
+    ----------
+    output_consensus
+        the path of the fasta file
+    name
+        the name of the sample
+    mincov
+        the minimum coverage, it is noted in the fasta headers
+    contigs
+        the names of the reference sequences, in the order they are written
+    sequences
+        the consensus sequence per reference sequence
+
+    """
+    with open(output_consensus, "w") as out:
+        for c in contigs:
+            out.write(
+                f">{RecordName(name, c, contigs)} mincov={mincov}\n{sequences[c]}\n"
+            )
+
+
+class _Inline:
+    """Stands in for an executor when only a single process may be used, the submitted
+    functions are run directly"""
+
+    def submit(self, fn, *args):
+        future = cf.Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
 
 
 def WriteOutputs(
     mincov,
-    iDict,
-    uGffDict,
-    inputbam,
+    indexes,
+    uGffDicts,
+    inserts,
     IncludeAmbig,
     output_vcf,
     name,
@@ -83,101 +355,99 @@ def WriteOutputs(
     output_gff,
     gffheader,
     output_consensus,
+    threads=1,
+    references=None,
+    depth_of_coverage=None,
+    start=0,
 ):
     """
-    step 1: construct the consensus sequences, both with and without inserts
-    step 2: write the vcf file
-    step 3: write the consensus sequence
-    """
-    today = date.today().strftime("%Y%m%d")
+    Every output file is a separate job that is started as soon as its inputs are
+    ready, with multiple threads these jobs and the consensus of every reference
+    sequence run in separate workers:
+    step 1: start writing the depth of coverage, it only needs the coverage
+    step 2: construct the consensus sequences, both with and without inserts, in a
+            single pass per reference sequence
+    step 3: start writing the updated GFF, the VCF and the consensus sequence
+    step 4: wait for all outputs, an error in any of the jobs is raised after the
+            other jobs have finished
 
-    bam = Readbam(inputbam)
-    consensus, newgff = BuildConsensus(mincov, iDict, uGffDict, IncludeAmbig, bam, True)
-    consensus_noinsert = BuildConsensus(
-        mincov, iDict, uGffDict, IncludeAmbig, bam, False
-    )[0]
+    Returns the BuildConsensus results per reference sequence.
+    """
+    contigs = list(indexes)
+    coverages = {c: indexes[c].coverage for c in contigs}
+    # Every job gets a copy of its arguments: the consensus of a reference sequence
+    # gets its PileupIndex, the other outputs only the coverage and what was called.
+    # The pool therefore only pays off with more than one reference sequence, a single
+    # one is handled in this process, which saves the copy of its index
+    if threads < 2 or len(contigs) < 2:
+        executor = _Inline()
+    else:
+        executor = cf.ProcessPoolExecutor(max_workers=threads)
 
-    if output_gff is not None:
-        
-        WriteGFF(gffheader, newgff, output_gff, name)
+    with executor as xc:
+        sinks = []
+        if depth_of_coverage is not None:
+            sinks.append(xc.submit(BuildCoverage, coverages, depth_of_coverage, start))
 
-    if output_vcf is not None:
-        hasinserts, insertpositions = ListInserts(iDict, mincov, bam)
+        futures = {
+            c: xc.submit(
+                BuildConsensus,
+                mincov,
+                indexes[c],
+                uGffDicts[c],
+                IncludeAmbig,
+                inserts[c],
+            )
+            for c in contigs
+        }
+        cf.wait(futures.values())
+        failed = [f for f in futures.values() if f.exception() is not None]
+        if not failed:
+            consensus = {c: f.result() for c, f in futures.items()}
 
-        q = 0
-        for record in SeqIO.parse(ref, "fasta"):
-            if q != 0:
-                break
-            q += 1
-            refID = record.id
-            reflist = list(record.seq)
+            if output_gff is not None:
+                # the keys are the line numbers of the original GFF file, which
+                # restores the original order
+                newgff = {}
+                for c in contigs:
+                    newgff.update(consensus[c][2])
+                sinks.append(
+                    xc.submit(
+                        WriteGFF,
+                        gffheader,
+                        dict(sorted(newgff.items())),
+                        output_gff,
+                        name,
+                    )
+                )
 
-        seqlist = list(consensus_noinsert.upper())
+            if output_vcf is not None:
+                sinks.append(
+                    xc.submit(
+                        WriteVCF,
+                        output_vcf,
+                        ref,
+                        mincov,
+                        coverages,
+                        {c: (consensus[c][1], consensus[c][3]) for c in contigs},
+                        references,
+                        start,
+                    )
+                )
 
-        with open(output_vcf, "w") as out:
-            out.write(
-                f"""##fileformat=VCFv4.3
-##fileDate={today}
-##source='TrueConsense {' '.join(sys.argv[1:])}'
-##reference='{ref}'
-##contig=<ID={refID}>
-##INFO=<ID=DP,Number=1,Type=Integer,Description="Read Depth">
-##INFO=<ID=INDEL,Number=0,Type=Flag,Description="Indicates that the variant is an INDEL.">
-#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO
-"""
+            sinks.append(
+                xc.submit(
+                    WriteConsensus,
+                    output_consensus,
+                    name,
+                    mincov,
+                    contigs,
+                    {c: consensus[c][0] for c in contigs},
+                )
             )
-            # writecontents
-
-            delskips = []
-            for i in range(len(reflist)):
-                if i in delskips:
-                    continue
-
-                if reflist[i] != seqlist[i]:
-                    b = i
-
-                    if seqlist[i] == "-":
-
-                        gapextendedreflist = []
-                        while seqlist[b] == "-":
-                            gapextendedreflist.append(reflist[b])
-                            delskips.append(b)
-                            b += 1
-
-                        gapextension = "".join(gapextendedreflist)
-                        joinedreflist = str(reflist[i - 1] + gapextension)
-
-                        currentcov = GetCoverage(iDict, i + 1)
-                        out.write(
-                            f"{refID}\t{i}\t.\t{joinedreflist}\t{seqlist[i-1]}\t.\tPASS\tDP={currentcov};INDEL\n"
-                        )
-                    else:
-                        if i == 0:
-                            p = 1
-                        elif i == 1:
-                            p = 1
-                        else:
-                            p = i
-                        currentcov = GetCoverage(iDict, p + 1)
-                        out.write(
-                            f"{refID}\t{i+1}\t.\t{reflist[i]}\t{seqlist[i]}\t.\tPASS\tDP={currentcov}\n"
-                        )
-                if hasinserts is True:
-                    for lposition in insertpositions:
-                        if i == lposition:
-                            currentcov = GetCoverage(iDict, i + 1)
-                            if currentcov > mincov:
-                                for y in insertpositions.get(lposition):
-                                    to_insert = str(
-                                        insertpositions.get(lposition).get(y)
-                                    )
-                                    if to_insert is not None:
-                                        CombinedEntry = seqlist[i] + to_insert
-                                        out.write(
-                                            f"{refID}\t{i}\t.\t{reflist[i]}\t{CombinedEntry}\t.\tPASS\tDP={currentcov};INDEL\n"
-                                        )
-                                    else:
-                                        continue
+        cf.wait(sinks)
 
-    with open(output_consensus, "w") as out:
-        out.write(f">{name} mincov={mincov}\n{consensus}\n")
+    for f in failed + sinks:
+        if f.exception() is not None:
+            raise f.exception()
+    return consensus
@@ -1,322 +1,323 @@
-import copy
+import numpy as np
 
-from .Ambig import IsAmbiguous
-from .Coverage import GetCoverage
-from .Events import ListInserts, MinorityDel
-from .ORFs import CorrectGFF, SolveTripletLength, in_orf
+from .Ambig import AmbiguityCodes
+from .Events import ListInserts, MinorityDeletions
+from .ORFs import FeatureIndex, FeatureTable, ORFTracker, SolveTripletLength, in_orf
 
 
-def WalkForward(index, p, fixedpositions="expand"):
-    """Function takes a dictionary of pileup data and current position, and returns a
-    dictionary of future positions which contain deletions
+def DeletionRuns(index):
+    """Gives the length of the stretch of positions with a deletion as the primary call
+    that starts at every position, in a single reverse sweep over the index. A deletion
+    is the primary call when no nucleotide has more reads, as X comes first in a tie
+    (see PileupIndex.rank_positions)
 
     Parameters
     ----------
     index
-        the index of the genome
-    p
-        the position of the nucleotide you want to start from
-        fixedpositions, optional
-        This is the number of nucleotides to walk forward. If you want to walk forward until you hit a
-        nucleotide, set this to "expand".
+        the PileupIndex of the genome
 
     Returns
     -------
-        A list of future positions which contain deletions.
+        An integer array, element p - 1 has the number of consecutive positions from p
+        onwards where the primary call is a deletion.
 
     """
-
-    if fixedpositions != "expand":
-        lastposition = list(enumerate(index))[-1][1]
-        p = p + 1
-        targetposition = p + fixedpositions
-
-        if targetposition >= lastposition:
-            targetposition = lastposition
-
-        nucleotrack = {}
-        while p != targetposition:
-            N, C = GetNucleotide(index, p, 1)
-            nucleotrack[p] = N
-            p += 1
-        return nucleotrack
-    else:
-        track = []
-        p = p + 1
-        while True:
-            N, C = GetNucleotide(index, p, 1)
-            if N == "X":
-                track.append(p)
-                p += 1
-            else:
-                break
-        return track
-
-
-def complement_index(index, gffdict, skips):
-    """Takes a dictionary of pileup data, a dictionary of gff features, and a list of positions to skip, and returns a
-    dictionary pileup data, with the addition of a new key, "ORF", which contains the which position in a codon the nucleotide-position has
+    primary_x = index.column("X") >= index.counts[:, 1:5].max(axis=1)
+    positions = np.arange(len(index))
+    # the first position without a deletion as primary call, at or after every position
+    nextcall = np.where(primary_x, len(index), positions)
+    nextcall = np.minimum.accumulate(nextcall[::-1])[::-1]
+    return nextcall - positions
+
+
+# The decisions of the consensus per position, see DecisionTable
+# coverage below the minimum: N
+N_CALL = 0
+# the precomputed symbol of the position
+BASE_CALL = 1
+# a minority deletion that completes the deletion run after it to whole codons: - and
+# skip the run
+DELETION_RUN = 2
+# like DELETION_RUN for two minority deletions in a row with the run after the second
+DELETION_PAIR = 3
+# deletion as primary call: the precomputed (secondary) symbol inside an ORF, - outside
+X_SECONDARY = 4
+# deletion as primary call followed by more deletions: - and inside an ORF also skip
+# the run
+X_RUN = 5
+
+# Whether a minority deletion group of m positions and the upcoming stretch of u
+# deletions together keep the reading frame, this only depends on m % 3 and u % 3 so it
+# is tabulated once with SolveTripletLength
+_TRIPLETS = np.array(
+    [[SolveTripletLength(range(u), range(m)) for u in range(3)] for m in range(3)]
+)
+
+
+# number of positions that DecisionTable ranks and decides at once
+_DECISION_BLOCK = 1 << 16
+
+
+def _ahead(a, s, e, k):
+    """Elements s + k to e + k of an array, with zeroes (or False) beyond its end"""
+    block = np.zeros(e - s, dtype=a.dtype)
+    part = a[s + k : e + k]
+    block[: len(part)] = part
+    return block
+
+
+def DecisionTable(index, mincov, IncludeAmbig):
+    """Decides the consensus of every position of the index at once, as far as it only
+    depends on the index itself. What is left for the walk along the genome are the
+    positions that are skipped because they are part of an earlier deletion, and whether
+    a position with a deletion as primary call lies within an ORF. The positions are
+    ranked and decided in blocks, so the ranked nucleotides are never held for the
+    whole genome.
 
     Parameters
     ----------
     index
-        a dictionary of the form {protein_id: {'start': start, 'stop': stop, 'strand': strand, 'ORF': ORF}}
-    gffdict
-        a dictionary of the gff file, with the keys being the gene names and the values being the start and
-        stop positions of the gene.
-    skips
-        a list of the names of the genes that you want to skip.
+        the PileupIndex of the reference sequence
+    mincov
+        the minimum coverage of a position to be included in the consensus
+    IncludeAmbig
+        whether ambiguity nucleotides may be used in the consensus
 
     Returns
     -------
-        The index is being returned.
+        An array with the decision (N_CALL, BASE_CALL, DELETION_RUN, DELETION_PAIR,
+        X_SECONDARY or X_RUN) of every position, an array with the symbol of every
+        position for BASE_CALL and X_SECONDARY, and an array with the length of the
+        stretch of deletions that starts at every position (see DeletionRuns). Element
+        p - 1 belongs to position p.
 
     """
-    for i, p in enumerate(index):
-        if p in skips:
-            continue
-        a = _orf_codonposition(gffdict, p)
-        index[p]["ORF"] = a
-    return index
+    if index.deletion_runs is None:
+        index.deletion_runs = DeletionRuns(index)
+    if index.minority_deletions is None:
+        index.minority_deletions = MinorityDeletions(index)
+    length = len(index)
+    runs = index.deletion_runs
+    minority = index.minority_deletions
+
+    actions = np.empty(length, dtype=np.int8)
+    symbols = np.empty(length, dtype="<U1")
+    for s in range(0, length, _DECISION_BLOCK):
+        e = min(s + _DECISION_BLOCK, length)
+        bases, counts = index.rank_positions(s, e)
+        cov = index.coverage[s:e]
+
+        # the deletion stretch and the minority deletion of the next positions, nothing
+        # lies beyond the end of the genome
+        forward = _ahead(runs, s, e, 1)
+        forward2 = _ahead(runs, s, e, 2)
+        minority0 = minority[s:e]
+        minority1 = _ahead(minority, s, e, 1)
+
+        def call(rank):
+            """The nucleotide of a rank, in lowercase when it has less reads than the
+            minimum coverage"""
+            upper = np.ascontiguousarray(bases[:, rank])
+            # the code points of the uppercase nucleotides only differ from the
+            # lowercase ones in bit 5
+            lower = (upper.view(np.uint32) | 0x20).view(upper.dtype)
+            return np.where(counts[:, rank] < mincov, lower, upper)
+
+        primary_x = bases[:, 0] == "X"
+        block_symbols = np.where(primary_x, call(1), call(0))
+        if IncludeAmbig is True:
+            ambiguity = AmbiguityCodes(bases, counts, cov)
+            block_symbols = np.where(ambiguity != "", ambiguity, block_symbols)
+        symbols[s:e] = block_symbols
+
+        deletion_run = minority0 & (forward > 0) & _TRIPLETS[1, forward % 3]
+        deletion_pair = (
+            minority0
+            & (forward == 0)
+            & minority1
+            & (forward2 > 0)
+            & _TRIPLETS[2, forward2 % 3]
+        )
+        actions[s:e] = np.select(
+            [
+                cov < mincov,
+                primary_x & (forward >= 2),
+                primary_x,
+                deletion_run,
+                deletion_pair,
+            ],
+            [N_CALL, X_RUN, X_SECONDARY, DELETION_RUN, DELETION_PAIR],
+            default=BASE_CALL,
+        )
+    return actions, symbols, runs
 
 
-def _orf_codonposition(gffdict, p):
-    """Takes a dictionary of ORFs and a position, and returns the ORF and the codon position of that
-    position
+def TrackedPositions(features, length):
+    """Marks the positions that are covered by at least one feature, the ORFs only have
+    to be followed there
 
     Parameters
     ----------
-    gffdict
-        a dictionary of gff features
-    p
-        position in the genome
+    features
+        the FeatureIndex of the gff file
+    length
+        the length of the reference sequence
 
     Returns
     -------
-        a tuple of the ORF name and the codon position of the position p.
+        A boolean array, element p - 1 belongs to position p.
 
     """
-    a = []
-    for k in gffdict.keys():
-        start = gffdict[k].get("start")
-        end = gffdict[k].get("end") + 1
-
-        if p in range(start, end):
-            # attributes itself can also be "", so both no attributes and empty attributes are skipped
-            attr = gffdict[k].get("attributes", "")
-            if not attr:
-                continue
-            split_attr = attr.split(";")
-            if len(split_attr) < 2:
-                a.extend((str(attr.split(";")[0].split("=")[-1]), (p - start) % 3))
-                continue
-            a.extend((str(attr.split(";")[1].split("=")[-1]), (p - start) % 3))
-    if a:
-        return tuple(a)
-    return None, None
-
-
-def GetNucleotide(iDict, position, count):
-    """Takes a dictionary of sequences, a position, and a count, and returns the nucleotide at that
-    position that occurs the most, and the number of times it occurs
+    tracked = np.zeros(length, dtype=bool)
+    for s, e, segment in zip(features.bounds, features.bounds[1:], features.segments):
+        if segment:
+            tracked[max(s, 1) - 1 : max(min(e - 1, length), 0)] = True
+    return tracked
+
+
+# number of positions of which the decisions are turned into lists at once by _walk
+_WALK_BLOCK = 1 << 16
+
+
+def _walk(p_index, features, GFFdict, decisions, insertpositions, mincov, includeINS):
+    """Walks along the genome to make the consensus from the decisions of the
+    DecisionTable, while the ORFs are followed to correct the gff features. The
+    decisions are read in blocks of _WALK_BLOCK positions, so only a block of them is
+    turned into Python objects at a time.
 
     Parameters
     ----------
-    iDict
-        The dictionary of of pileup data
-    position
-        the position in the sequence you want to get the nucleotide for
-    count
-        the number of nucleotides you want to return
+    p_index
+        the PileupIndex of the reference sequence
+    features
+        the FeatureIndex of the gff features
+    GFFdict
+        a dictionary of the gff features
+    decisions
+        arrays with the action, symbol, deletion run, coverage, whether an insertion is
+        added and whether the ORFs are followed of every position
+    insertpositions
+        the dictionary of insert positions, None if there are no insertions
+    mincov
+        the minimum coverage of a position to be included in the consensus
+    includeINS
+        whether the insertions are added to the consensus
 
     Returns
     -------
-        The nucleotide and the frequency of that nucleotide at a given position.
+        The consensus sequence and the FeatureTable with the corrected gff features.
 
     """
-    sorteddist = sorted(
-        ((value, key) for key, value in GetDistribution(iDict, position).items())
-    )
-    return sorteddist[-count][1], sorteddist[-count][0]
+    actions, symbols, runs, coverage, inserted, tracked = decisions
+    length = len(p_index)
+    cons = []
+
+    # positions that are already part of a deletion in the consensus, one flag each
+    dskips = bytearray(length + 2)
+
+    # the corrected positions are kept in a separate table, GFFdict isn't modified
+    table = FeatureTable(GFFdict)
+    orfs = ORFTracker(table, features)
+
+    for s in range(0, length, _WALK_BLOCK):
+        e = min(s + _WALK_BLOCK, length)
+        block_actions = actions[s:e].tolist()
+        block_symbols = symbols[s:e].tolist()
+        block_inserted = inserted[s:e].tolist()
+        block_tracked = tracked[s:e].tolist()
+        block_coverage = coverage[s:e].tolist()
+
+        for i in range(e - s):
+            b = s + i + 1
+            if dskips[b]:
+                cons.append("-")
+            else:
+                action = block_actions[i]
+                if action == BASE_CALL:
+                    cons.append(block_symbols[i])
+                elif action == N_CALL:
+                    cons.append("N")
+                elif action == DELETION_RUN:
+                    cons.append("-")
+                    # the minority deletion itself and the stretch of deletions after
+                    # it, the DecisionTable only picks this when the stretch lies
+                    # within the genome
+                    n = int(runs[b])
+                    dskips[b : b + 1 + n] = b"\x01" * (1 + n)
+                elif action == DELETION_PAIR:
+                    cons.append("-")
+                    # both minority deletions and the deletion stretch after the second
+                    # one
+                    n = int(runs[b + 1])
+                    dskips[b : b + 2 + n] = b"\x01" * (2 + n)
+                elif not in_orf(b, table, features):
+                    cons.append("-")
+                elif action == X_SECONDARY:
+                    cons.append(block_symbols[i])
+                else:
+                    cons.append("-")
+                    n = int(runs[b])
+                    dskips[b : b + 1 + n] = b"\x01" * (1 + n)
+
+                if includeINS and block_inserted[i]:
+                    for size in insertpositions[b]:
+                        cons.append(str(insertpositions[b][size]))
+
+            # the starts of the features are shifted by the insertions either way
+            if block_tracked[i]:
+                orfs.update(cons, b, insertpositions, mincov, block_coverage[i])
 
+    return "".join(cons), table
 
-def GetDistribution(iDict, position):
-    """Takes a dictionary of dictionaries and a position and returns a dictionary of the distribution of
-    nucleotides at that position
+
+def BuildConsensus(mincov, iDict, GFFdict, IncludeAmbig, inserts):
+    """Builds the consensus sequence with and without the called insertions. The
+    decision of every position is looked up in the DecisionTable, the walk along the
+    genome only skips the positions of earlier deletions and follows the ORFs. Without
+    called insertions both consensus sequences are the same and the walk is done once,
+    otherwise the consensus without insertions gets its own walk, as the ORF ends (and
+    so the deletions within ORFs) are found on the sequence without the insertions.
 
     Parameters
     ----------
+    mincov
+        the minimum coverage of a position to be included in the consensus
     iDict
-        the dictionary pileup data
-    position
-        the position in the sequence that you want to get the distribution for
+        the PileupIndex of the reference sequence
+    GFFdict
+        a dictionary of the gff features
+    IncludeAmbig
+        whether ambiguity nucleotides may be used in the consensus
+    inserts
+        the insertion allele table of the reference sequence, made by BuildIndex
 
     Returns
     -------
-        A dictionary of the distribution of nucleotides at a given position.
+        The consensus with insertions, the consensus without insertions, the corrected
+        gff dictionary and the dictionary of insert positions (None if there are no
+        insertions).
 
     """
-    dist = {}
-    dist["A"] = iDict[position].get("A")
-    dist["T"] = iDict[position].get("T")
-    dist["C"] = iDict[position].get("C")
-    dist["G"] = iDict[position].get("G")
-    dist["X"] = iDict[position].get("X")
-    return dist
-
-
-def BuildConsensus(mincov, iDict, GFFdict, IncludeAmbig, bam, includeINS):
-    cons = []
-
-    p_index = complement_index(iDict, GFFdict, [])
-
-    hasinserts, insertpositions = ListInserts(p_index, mincov, bam)
-
-    dskips = []
-
-    newGffdict = copy.deepcopy(GFFdict)
-
-    for a, b in enumerate(p_index):
-
-        cov = GetCoverage(p_index, b)
-        within_orf = in_orf(b, newGffdict)
-
-        if b in dskips:
-            cons.append("-")
-            newGffdict = CorrectGFF(
-                GFFdict, newGffdict, cons, b, insertpositions, mincov, cov
-            )
-            continue
-
-        if cov < mincov:
-            cons.append("N")
-            # Simply add a 'N' to the consensus at this position if the coverage is below the threshold
-            newGffdict = CorrectGFF(
-                GFFdict, newGffdict, cons, b, insertpositions, mincov, cov
-            )
-            continue
-        else:
-            PrimaryN, PrimaryC = GetNucleotide(p_index, b, 1)
-            # get the primary nucleotide at this position
-
-            HasAmbiguity, AmbigChar = IsAmbiguous(
-                GetNucleotide(p_index, b, 1),
-                GetNucleotide(p_index, b, 2),
-                GetNucleotide(p_index, b, 3),
-                GetNucleotide(p_index, b, 4),
-                cov,
-            )
-
-            if PrimaryN != "X":
-
-                if MinorityDel(p_index, b) is True:
-
-                    if not WalkForward(p_index, b):
-
-                        if MinorityDel(p_index, b + 1) is True:
-
-                            if WalkForward(p_index, b + 1):
-
-                                uds = WalkForward(p_index, b + 1)
-                                mds = [b, b + 1]
-                                if SolveTripletLength(uds, mds) is True:
-                                    cons.append("-")
-                                    for x in mds:
-                                        dskips.append(x)
-                                    for x in uds:
-                                        dskips.append(x)
-                                else:
-                                    if IncludeAmbig is True and HasAmbiguity is True:
-                                        cons.append(AmbigChar)
-                                    else:
-                                        if PrimaryC < mincov:
-                                            cons.append(PrimaryN.lower())
-                                        else:
-                                            cons.append(PrimaryN.upper())
-                            else:
-                                if IncludeAmbig is True and HasAmbiguity is True:
-                                    cons.append(AmbigChar)
-                                else:
-                                    if PrimaryC < mincov:
-                                        cons.append(PrimaryN.lower())
-                                    else:
-                                        cons.append(PrimaryN.upper())
-                        else:
-                            if IncludeAmbig is True and HasAmbiguity is True:
-                                cons.append(AmbigChar)
-                            else:
-                                if PrimaryC < mincov:
-                                    cons.append(PrimaryN.lower())
-                                else:
-                                    cons.append(PrimaryN.upper())
-                    else:
-                        uds = WalkForward(p_index, b)
-                        mds = [b]
-                        if SolveTripletLength(uds, mds) is True:
-                            cons.append("-")
-                            dskips.append(b)
-                            for x in uds:
-                                dskips.append(x)
-                        else:
-                            if IncludeAmbig is True and HasAmbiguity is True:
-                                cons.append(AmbigChar)
-                            else:
-                                if PrimaryC < mincov:
-                                    cons.append(PrimaryN.lower())
-                                else:
-                                    cons.append(PrimaryN.upper())
-                else:
-                    if IncludeAmbig is True and HasAmbiguity is True:
-                        cons.append(AmbigChar)
-                    else:
-                        if PrimaryC < mincov:
-                            cons.append(PrimaryN.lower())
-                        else:
-                            cons.append(PrimaryN.upper())
-
-            if PrimaryN == "X":
-                if within_orf is True:
-                    if b in dskips:  # this might be redundant, check later
-                        cons.append("-")
-                    else:
-                        if not WalkForward(p_index, b):
-                            SecondaryN, SecondaryC = GetNucleotide(p_index, b, 2)
-                            if IncludeAmbig is True and HasAmbiguity is True:
-                                cons.append(AmbigChar)
-                            else:
-                                if SecondaryC < mincov:
-                                    cons.append(SecondaryN.lower())
-                                else:
-                                    cons.append(SecondaryN.upper())
-                        else:
-                            wfds = WalkForward(p_index, b)
-                            if len(wfds) >= 2:
-                                cons.append("-")
-                                dskips.append(b)
-                                for x in wfds:
-                                    dskips.append(x)
-                            else:
-                                SecondaryN, SecondaryC = GetNucleotide(p_index, b, 2)
-                                if IncludeAmbig is True and HasAmbiguity is True:
-                                    cons.append(AmbigChar)
-                                else:
-                                    if SecondaryC < mincov:
-                                        cons.append(SecondaryN.lower())
-                                    else:
-                                        cons.append(SecondaryN.upper())
-                else:
-                    cons.append("-")
-
-        if includeINS is True:
-            if cov > mincov:
-                if hasinserts is True:
-                    for x in insertpositions:
-                        if b == x:
-                            for i in insertpositions.get(x):
-                                cons.append(str(insertpositions.get(x).get(i)))
-
-        newGffdict = CorrectGFF(
-            GFFdict, newGffdict, cons, b, insertpositions, mincov, cov
+    features = FeatureIndex(GFFdict)
+    hasinserts, insertpositions = ListInserts(iDict, mincov, inserts)
+
+    actions, symbols, runs = DecisionTable(iDict, mincov, IncludeAmbig)
+    coverage = iDict.coverage
+    # insertions are only added after positions with more than the minimum coverage
+    inserted = np.zeros(len(iDict), dtype=bool)
+    if hasinserts is True:
+        positions = np.fromiter(insertpositions, dtype=np.int64)
+        inserted[positions - 1] = coverage[positions - 1] > mincov
+    # the ORF tracker only has to see the positions within features or with an insertion
+    tracked = TrackedPositions(features, len(iDict)) | inserted
+
+    decisions = (actions, symbols, runs, coverage, inserted, tracked)
+    consensus, table = _walk(
+        iDict, features, GFFdict, decisions, insertpositions, mincov, True
+    )
+    consensus_noinsert = consensus
+    if inserted.any():
+        consensus_noinsert, _ = _walk(
+            iDict, features, GFFdict, decisions, insertpositions, mincov, False
         )
-
-    return "".join(cons), newGffdict
+    return consensus, consensus_noinsert, table.to_dict(), insertpositions
@@ -3,22 +3,23 @@
 """
 
 import argparse
-import concurrent.futures as cf
 import multiprocessing
 import os
 import pathlib
 import sys
 
-from .Coverage import BuildCoverage
-from .func import MyHelpFormatter, color
+from .Cache import AddCacheArguments, CacheFromArgs
+from .func import MyHelpFormatter, checkfasta, checkgff, color
 from .indexing import (
     BuildIndex,
     Gffindex,
     Override_index_positions,
-    Readbam,
+    ParseRegion,
+    PileupIndex,
+    ReadReference,
     read_override_index,
 )
-from .Outputs import WriteOutputs
+from .Outputs import RecordName, WriteOutputs
 from .version import __version__
 
 
@@ -34,39 +35,18 @@ def GetArgs(givenargs):
         print(f'"{fname}" is not a file. Exiting...')
         sys.exit(-1)
 
-    def checkfasta(fname):
-        allowedexts = [".fasta", ".fa"]
-        if os.path.isfile(fname):
-            ext = "".join(pathlib.Path(fname).suffix)
-            if ext not in allowedexts:
-                parser.error(
-                    f"Reference file {color.YELLOW}({fname}){color.END} doesn't seem to be a Fasta-file."
-                )
-            return fname
-        print(f'"{fname}" is not a file. Exiting...')
-        sys.exit(1)
-
-    def checkgff(fname):
-        if os.path.isfile(fname):
-            ext = "".join(pathlib.Path(fname).suffix)
-            if ext != ".gff":
-                parser.error(
-                    f"Given file {color.YELLOW}({fname}){color.END} doesn't seem to be a GFF file."
-                )
-            return fname
-        print(f'"{fname}" is not a file. Exiting...')
-        sys.exit(1)
-
     def check_index_override(fname):
         if os.path.isfile(fname):
             ext = "".join(pathlib.Path(fname).suffixes)
+            if ext.endswith((".npz", ".parquet")):
+                return fname
             if ".csv" not in ext:
                 parser.error(
-                    f"Given file {color.YELLOW}({fname}){color.END} doesn't seem to be a compressed csv file."
+                    f"Given file {color.YELLOW}({fname}){color.END} doesn't seem to be a compressed csv, .npz or .parquet file."
                 )
             if ".gz" not in ext:
                 parser.error(
-                    f"Given file {color.YELLOW}({fname}){color.END} doesn't seem to be a compressed csv file."
+                    f"Given file {color.YELLOW}({fname}){color.END} doesn't seem to be a compressed csv, .npz or .parquet file."
                 )
             return fname
         print(f'"{fname}" is not a file. Exiting...')
@@ -97,7 +77,7 @@ def GetArgs(givenargs):
         "--output",
         "-o",
         type=str,
-        default=os.getcwd() + 'consensus.fasta',
+        default=os.getcwd() + "consensus.fasta",
         metavar="File",
         help="Output consensus fasta",
         required=True,
@@ -106,7 +86,7 @@ def GetArgs(givenargs):
     reqs.add_argument(
         "--reference",
         "-ref",
-        type=checkfasta,
+        type=lambda fname: checkfasta(parser, fname),
         metavar="File",
         help="Reference Fasta file",
         required=True,
@@ -115,7 +95,7 @@ def GetArgs(givenargs):
     reqs.add_argument(
         "--features",
         "-gff",
-        type=checkgff,
+        type=lambda fname: checkgff(parser, fname),
         metavar="File",
         help="File with genome features (GFF)",
         required=True,
@@ -146,7 +126,7 @@ def GetArgs(givenargs):
         "-vcf",
         type=str,
         metavar="File",
-        help="Output VCF file",
+        help="Output VCF file\nA filename ending with .gz gives a bgzip-compressed VCF file with a tabix index",
     )
 
     opts.add_argument(
@@ -154,7 +134,7 @@ def GetArgs(givenargs):
         "-doc",
         type=str,
         metavar="File",
-        help="Output TSV file listing the coverage per position",
+        help="Output TSV file listing the coverage per position\nA filename ending with .gz gives a bgzip-compressed file with a tabix index, .bedgraph (or .bg) gives a bedGraph file and .npz gives a binary numpy file",
     )
 
     opts.add_argument(
@@ -170,10 +150,18 @@ def GetArgs(givenargs):
         "-t",
         default=standard_threads,
         metavar="N",
-        help="Number of threads that can be used by TrueConsense",
+        help="Number of threads that can be used by TrueConsense\nThe index is built with this many processes, each working on a separate region of the reference",
         type=int,
     )
 
+    opts.add_argument(
+        "--region",
+        "-r",
+        type=str,
+        metavar="contig:start-end",
+        help="Only make the consensus of this region of the reference (1-based, inclusive), only its reads are piled up so the memory use follows the size of the region\nThe VCF and coverage keep the positions of the reference, the corrected GFF only has the features that lie entirely within the region, on the positions of its consensus",
+    )
+
     opts.add_argument(
         "--noambiguity",
         "-noambig",
@@ -185,9 +173,18 @@ def GetArgs(givenargs):
         "--index-override",
         type=check_index_override,
         metavar="File",
-        help="Override the positional index of certain genome positions with 'known' information if the given alignment is not sufficient for these positions\nMust be a compressed csv.\nPlease use with caution as this will overwrite the generated index at the given positions!\n",
+        help="Override the positional index of certain genome positions with 'known' information if the given alignment is not sufficient for these positions\nMust be a compressed csv, a .npz or a .parquet file.\nPlease use with caution as this will overwrite the generated index at the given positions!\n",
     )
 
+    opts.add_argument(
+        "--index-override-report",
+        type=str,
+        metavar="File",
+        help="Output TSV file listing the positions that were changed by the index override, with their coverage before and after",
+    )
+
+    AddCacheArguments(opts)
+
     opts.add_argument(
         "--version",
         "-v",
@@ -209,6 +206,156 @@ def GetArgs(givenargs):
     return args
 
 
+def ProcessSample(
+    inputbam,
+    samplename,
+    reference,
+    IndexGff,
+    mincov,
+    IncludeAmbig,
+    output,
+    variants=None,
+    output_gff=None,
+    depth_of_coverage=None,
+    override=None,
+    threads=1,
+    references=None,
+    cache=None,
+    override_report=None,
+    region=None,
+):
+    """Builds the index of a single bam file and writes the consensus and the other
+    requested outputs. The parsed features (and optionally the reference sequences) are
+    given by the caller, so they can be read once and shared between multiple samples.
+
+    Parameters
+    ----------
+    inputbam
+        the path to the bam file
+    samplename
+        the name of the sample, used for the fasta headers and the GFF seqid
+    reference
+        the path to the reference fasta
+    IndexGff
+        the parsed GFF file, as returned by Gffindex. It isn't modified
+    mincov
+        the minimum coverage
+    IncludeAmbig
+        whether ambiguity nucleotides may be used in the consensus
+    output
+        the path of the output consensus fasta
+    variants, optional
+        the path of the output VCF file
+    output_gff, optional
+        the path of the output GFF file
+    depth_of_coverage, optional
+        the path of the output coverage TSV file
+    override, optional
+        a dataframe with positions of the index that have to be overridden, see
+        read_override_index
+    threads, optional
+        the number of processes that can be used for this sample
+    references, optional
+        the Reference of the reference fasta (see ReadReference), it is opened here when
+        not given
+    cache, optional
+        an IndexCache that is used for the index of the bam file
+    override_report, optional
+        the path of the output TSV file with the positions that were changed by the
+        override
+    region, optional
+        a (contig, start, end) tuple made by ParseRegion, only this region of the
+        reference is piled up and written to the outputs
+
+    Returns
+    -------
+        A tuple with the PileupIndex and the BuildConsensus results, both per reference
+        sequence, and the report of the override (see Override_index_positions), None
+        without override.
+
+    """
+    # the reference is opened once, the index, consensus and VCF stages all use it
+    if references is None:
+        references = ReadReference(reference)
+
+    # BuildIndex divides the pileup over worker processes by itself, it is called from
+    # the main thread so the workers aren't forked while other threads are still running
+    Counts, Inserts = BuildIndex(
+        inputbam, reference, threads, references.lengths, cache, region
+    )
+
+    contigs = list(Counts)
+    PileupIndexes = {c: PileupIndex(counts) for c, counts in Counts.items()}
+    start = 0 if region is None else region[1]
+
+    if (
+        override is not None
+        and region is not None
+        and "contig" not in override.columns
+        and region[0] != next(iter(references))
+    ):
+        # the override is of the first reference sequence, not of the region
+        override = override.iloc[:0]
+
+    report = None
+    if override is not None:
+        report = Override_index_positions(PileupIndexes, override, region)
+        if override_report is not None:
+            report.to_csv(override_report, sep="\t", index=False)
+
+    GffHeader = IndexGff.header
+    GffDF = IndexGff.df.copy()
+    if len(references) == 1:
+        # With a single reference sequence all features belong to it, regardless of
+        # their seqid
+        GffDF["seqid"] = contigs[0]
+    else:
+        unmatched = GffDF.loc[~GffDF["seqid"].isin(list(references)), "seqid"]
+        if len(unmatched) > 0:
+            seqids = ", ".join(map(str, unmatched.unique()))
+            print(
+                f"Warning: {len(unmatched)} feature(s) of the GFF file have a seqid "
+                f"that is not in the reference ({seqids}), "
+                "these are left out of the corrected GFF file",
+                file=sys.stderr,
+            )
+    if region is not None:
+        # only the features that lie entirely within the region are kept, on the
+        # positions of the consensus of the region
+        contig, _, end = region
+        GffDF = GffDF[
+            (GffDF["seqid"] == contig)
+            & (GffDF["start"] > start)
+            & (GffDF["end"] <= end)
+        ].copy()
+        GffDF["start"] -= start
+        GffDF["end"] -= start
+    GffDicts = {}
+    for c in contigs:
+        ContigDF = GffDF[GffDF["seqid"] == c].copy()
+        ContigDF["seqid"] = RecordName(samplename, c, contigs)
+        GffDicts[c] = ContigDF.to_dict("index")
+
+    consensus = WriteOutputs(
+        mincov,
+        PileupIndexes,
+        GffDicts,
+        Inserts,
+        IncludeAmbig,
+        variants,
+        samplename,
+        reference,
+        output_gff,
+        GffHeader,
+        output,
+        threads,
+        references,
+        depth_of_coverage,
+        start,
+    )
+    return PileupIndexes, consensus, report
+
+
 def main(args: list[str] | None = None):
     if not args:
         args = sys.argv[1:]
@@ -220,45 +367,36 @@ def main(args: list[str] | None = None):
         sys.exit(1)
     parsed_args = GetArgs(args)
 
-    bam = Readbam(parsed_args.input)
-
-    with cf.ThreadPoolExecutor(max_workers=parsed_args.threads) as xc:
-        IndexDF = xc.submit(BuildIndex, parsed_args.input, parsed_args.reference)
-        IndexGff = xc.submit(Gffindex, parsed_args.features)
-
-        IndexDF = IndexDF.result()
-        IndexGff = IndexGff.result()
-
-    if parsed_args.index_override:
-        IndexDF = Override_index_positions(
-            IndexDF, read_override_index(parsed_args.index_override)
-        )
-
-    indexDict = IndexDF.to_dict("index")
-    GffHeader = IndexGff.header
-    GffDF = IndexGff.df
-    GffDF["seqid"] = parsed_args.samplename
-    GffDict = GffDF.to_dict("index")
-
-    with cf.ThreadPoolExecutor(max_workers=parsed_args.threads) as xc:
-        if parsed_args.depth_of_coverage is not None:
-            xc.submit(BuildCoverage, indexDict, parsed_args.depth_of_coverage)
-
     if parsed_args.noambiguity is False:
         IncludeAmbig = True
     elif parsed_args.noambiguity is True:
         IncludeAmbig = False
 
-    WriteOutputs(
-        parsed_args.coverage_level,
-        indexDict,
-        GffDict,
+    references = ReadReference(parsed_args.reference)
+    region = None
+    if parsed_args.region:
+        region = ParseRegion(parsed_args.region, references.lengths)
+
+    cache = CacheFromArgs(parsed_args)
+    override = None
+    if parsed_args.index_override:
+        override = read_override_index(parsed_args.index_override, cache)
+
+    ProcessSample(
         parsed_args.input,
-        IncludeAmbig,
-        parsed_args.variants,
         parsed_args.samplename,
         parsed_args.reference,
-        parsed_args.output_gff,
-        GffHeader,
+        Gffindex(parsed_args.features),
+        parsed_args.coverage_level,
+        IncludeAmbig,
         parsed_args.output,
+        variants=parsed_args.variants,
+        output_gff=parsed_args.output_gff,
+        depth_of_coverage=parsed_args.depth_of_coverage,
+        override=override,
+        threads=parsed_args.threads,
+        references=references,
+        cache=cache,
+        override_report=parsed_args.index_override_report,
+        region=region,
     )
@@ -1,6 +1,8 @@
 import argparse
 import os
+import pathlib
 import shutil
+import sys
 
 
 class MyHelpFormatter(argparse.RawTextHelpFormatter):
@@ -38,3 +40,58 @@ class color:
     BOLD = "\033[1m"
     UNDERLINE = "\033[4m"
     END = "\033[0m"
+
+
+def checkfasta(parser, fname):
+    """Checks the reference fasta argument of a command, exits when it isn't a fasta file
+
+    Parameters
+    ----------
+    parser
+        the argparse.ArgumentParser of the command
+    fname
+        the given path
+
+    Returns
+    -------
+        The path.
+
+    """
+    allowedexts = [".fasta", ".fa"]
+    if os.path.isfile(fname):
+        ext = "".join(pathlib.Path(fname).suffix)
+        if ext not in allowedexts:
+            parser.error(
+                f"Reference file {color.YELLOW}({fname}){color.END} "
+                "doesn't seem to be a Fasta-file."
+            )
+        return fname
+    print(f'"{fname}" is not a file. Exiting...')
+    sys.exit(1)
+
+
+def checkgff(parser, fname):
+    """Checks the features argument of a command, exits when it isn't a GFF file
+
+    Parameters
+    ----------
+    parser
+        the argparse.ArgumentParser of the command
+    fname
+        the given path
+
+    Returns
+    -------
+        The path.
+
+    """
+    if os.path.isfile(fname):
+        ext = "".join(pathlib.Path(fname).suffix)
+        if ext != ".gff":
+            parser.error(
+                f"Given file {color.YELLOW}({fname}){color.END} "
+                "doesn't seem to be a GFF file."
+            )
+        return fname
+    print(f'"{fname}" is not a file. Exiting...')
+    sys.exit(1)
@@ -1,22 +1,85 @@
+import concurrent.futures as cf
+import itertools
+import sys
+
 from AminoExtract import SequenceReader, GFFDataFrame
+import numpy as np
 import pandas as pd
 import pysam
 
 
-def Readbam(f):
-    """Reads in a bam file and returns a pysam.AlignmentFile object
+class Reference:
+    """The sequences of a reference fasta, read through the fasta index (.fai, which is
+    made when it is missing). The names and lengths come from the fasta index, a
+    sequence is only read when it is asked for and is then kept as bytes. A single
+    Reference is shared by the index, consensus and VCF stages, it can be sent to worker
+    processes together with the sequences that were read so far.
 
     Parameters
     ----------
-    f
-        the name of the bam file
+    path
+        the path to the reference fasta
+
+    Attributes
+    ----------
+    path
+        the path to the reference fasta
+    lengths
+        a dictionary with the length of every sequence, in the order of the fasta
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with pysam.FastaFile(path) as fasta:
+            self.lengths = dict(zip(fasta.references, fasta.lengths))
+        self._sequences = {}
+
+    def __iter__(self):
+        return iter(self.lengths)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def sequence(self, name):
+        """Gives a sequence of the fasta
+
+        Parameters
+        ----------
+        name
+            the name of the sequence
+
+        Returns
+        -------
+            The sequence as bytes, in the case of the fasta.
+
+        """
+        if name not in self._sequences:
+            with pysam.FastaFile(self.path) as fasta:
+                self._sequences[name] = fasta.fetch(name).encode()
+        return self._sequences[name]
+
+    def array(self, name):
+        """Gives a sequence of the fasta as a read-only uint8 array of its characters,
+        without copying it"""
+        return np.frombuffer(self.sequence(name), dtype=np.uint8)
+
+
+def ReadReference(ref):
+    """Opens a reference fasta, its sequences are read when they are first used
+
+    Parameters
+    ----------
+    ref
+        the path to the reference fasta
 
     Returns
     -------
-        A pysam.AlignmentFile object
+        A Reference with the names and lengths of the sequences, in the order of the
+        fasta.
 
     """
-    return pysam.AlignmentFile(f, "rb")
+    return Reference(ref)
 
 
 def Gffindex(file: str) -> GFFDataFrame:
@@ -36,119 +99,909 @@ def Gffindex(file: str) -> GFFDataFrame:
     return reader.read_gff(file)
 
 
-def read_override_index(f):
-    """Reads a csv file, and uses the first column as the index
+# Column layout of the pileup count matrix, this is also the column order of the index
+INDEX_COLUMNS = ["coverage", "A", "T", "C", "G", "X", "I"]
+_COLUMN_NUMBERS = {name: i for i, name in enumerate(INDEX_COLUMNS)}
+# the nucleotide columns of the index, and the alphabetical position of each of them
+_DISTRIBUTION = np.array(INDEX_COLUMNS[1:6])
+_ALPHABETICAL = np.argsort(np.argsort(_DISTRIBUTION))
+# number of positions that are ranked at once, see PileupIndex.rank_positions
+_RANK_BLOCK = 1 << 18
+
+# Columns of the insertion allele table
+ALLELE_COLUMNS = ["position", "sequence", "length", "count", "fraction"]
+
+# Columns of the report of an index override
+OVERRIDE_REPORT_COLUMNS = [
+    "contig",
+    "position",
+    "coverage_before",
+    "coverage_after",
+    "coverage_delta",
+    "changed",
+]
+
+
+def _override_from_arrays(arrays, f):
+    """Makes the override dataframe of the arrays of an .npz override file
+    (or of a cached override)"""
+    if "position" not in arrays:
+        print(f"Index override {f} has no 'position' array. Exiting...")
+        sys.exit(1)
+    data = {k: arrays[k] for k in arrays if k != "position"}
+    if "contig" in data:
+        data["contig"] = data["contig"].astype(str).astype(object)
+    return pd.DataFrame(data, index=pd.Index(arrays["position"], name=None))
+
+
+def _override_to_arrays(override):
+    """The arrays of an override dataframe, in the layout of an .npz override file"""
+    arrays = {"position": override.index.to_numpy(dtype=np.int64)}
+    for c in override.columns:
+        if c == "contig":
+            arrays[c] = override[c].to_numpy(dtype=str)
+        else:
+            arrays[c] = override[c].to_numpy(dtype=np.int64)
+    return arrays
+
+
+def _validate_override(override, f):
+    """Checks the columns and values of an override table, and gives them as integer
+    columns. Problems are reported and end the program, like the other checks of the
+    input files.
+    """
+    unknown = [c for c in override.columns if c not in INDEX_COLUMNS and c != "contig"]
+    if unknown:
+        print(
+            f"Index override {f} has unknown column(s): "
+            f"{', '.join(map(str, unknown))}. "
+            f"Allowed are {', '.join(INDEX_COLUMNS)} and contig. Exiting..."
+        )
+        sys.exit(1)
+    columns = [c for c in override.columns if c != "contig"]
+    if not columns:
+        print(
+            f"Index override {f} has none of the columns "
+            f"{', '.join(INDEX_COLUMNS)}. Exiting..."
+        )
+        sys.exit(1)
+    values = override[columns].apply(pd.to_numeric, errors="coerce")
+    invalid = (
+        values.isna().any(axis=1)
+        | (values < 0).any(axis=1)
+        | (values % 1 != 0).any(axis=1)
+    )
+    positions = pd.to_numeric(pd.Series(override.index), errors="coerce")
+    invalid |= (positions.isna() | (positions < 1) | (positions % 1 != 0)).to_numpy()
+    if invalid.any():
+        rows = ", ".join(map(str, override.index[invalid.to_numpy()][:5]))
+        print(
+            f"Index override {f} has {invalid.sum()} row(s) with a missing, "
+            "negative or non-integer value or position "
+            f"(first: {rows}). Exiting..."
+        )
+        sys.exit(1)
+    validated = values.astype(np.int64)
+    validated.index = positions.astype(np.int64).to_numpy()
+    if "contig" in override.columns:
+        validated.insert(0, "contig", override["contig"].astype(str).to_numpy())
+    keys = validated["contig"] if "contig" in validated.columns else None
+    duplicated = pd.DataFrame(
+        {"contig": keys, "position": validated.index}
+    ).duplicated()
+    if duplicated.any():
+        rows = ", ".join(map(str, validated.index[duplicated.to_numpy()][:5]))
+        print(f"Index override {f} has repeated position(s): {rows}. Exiting...")
+        sys.exit(1)
+    return validated
+
+
+def read_override_index(f, cache=None):
+    """Reads the override data of the index. The format follows from the name of the
+    file: .npz is a numpy file with a 'position' array, the arrays of the overridden
+    columns and an optional 'contig' array, .parquet is a parquet table (this needs
+    pyarrow or fastparquet) and anything else is a (compressed) csv file.
+    Tables have the position as their first column. A csv file is parsed once, after
+    that the parsed table is taken from the cache until the file changes.
 
     Parameters
     ----------
     f
         the file to read
+    cache, optional
+        an IndexCache that keeps the parsed contents of csv files
 
     Returns
     -------
-        A dataframe with the index column being the first column.
+        A dataframe indexed on the position, with integer columns from INDEX_COLUMNS and
+        an optional "contig" column.
 
     """
-    return pd.read_csv(f, sep=",", compression="gzip", index_col=0)
+    name = f.lower()
+    if name.endswith(".npz"):
+        with np.load(f) as arrays:
+            return _validate_override(_override_from_arrays(arrays, f), f)
+    if name.endswith(".parquet"):
+        try:
+            override = pd.read_parquet(f)
+        except ImportError:
+            print(
+                f"Reading the parquet file {f} requires pyarrow or fastparquet, "
+                "please install one of them "
+                "or give the override as a .npz or .csv.gz file. Exiting..."
+            )
+            sys.exit(1)
+        if "position" in override.columns:
+            override = override.set_index("position")
+        return _validate_override(override, f)
+
+    key = None
+    if cache is not None:
+        key = cache.file_key(f, "override")
+        arrays = cache.load_arrays(key)
+        if arrays is not None:
+            return _override_from_arrays(arrays, f)
+    override = _validate_override(
+        pd.read_csv(f, sep=",", compression="infer", index_col=0), f
+    )
+    if key is not None:
+        cache.save_arrays(key, _override_to_arrays(override))
+    return override
 
 
-def Override_index_positions(index, override_data):
-    """Takes a dataframe and a second dataframe with the same index and columns, and replaces the values
-    in the first dataframe with the values in the second dataframe
+def Override_index_positions(indexes, override_data, region=None):
+    """Replaces the counts of the positions in the override data in the count matrices
+    of the index. Only the columns that are in the override data are replaced, the other
+    columns of these positions are kept.
 
     Parameters
     ----------
-    index
-        the index of the dataframe you want to override
+    indexes
+        a dictionary with the PileupIndex per reference sequence, these are modified in
+        place
     override_data
-        a dataframe with the same columns as the index, but with the values you want to override
+        a dataframe with columns of the index and the values you want to override, see
+        read_override_index. An optional "contig" column selects the reference sequence
+        per row, without it the first reference sequence is overridden.
+    region, optional
+        the (contig, start, end) tuple of the region of the index (see ParseRegion),
+        the positions of the override that lie outside of it are left out
 
     Returns
     -------
-        Dataframe with the overridden data.
+        A dataframe with a row per position of which the counts changed, with the
+        columns given in OVERRIDE_REPORT_COLUMNS:
+        contig: the reference sequence
+        position: the position in the reference sequence
+        coverage_before: the coverage before the override
+        coverage_after: the coverage after the override
+        coverage_delta: the difference between these two
+        changed: the names of the columns that changed, separated by commas
 
     """
-    index.loc[override_data.index, :] = override_data[:]
-    return index
+    if "contig" in override_data.columns:
+        groups = override_data.groupby("contig", sort=False)
+    else:
+        groups = [(next(iter(indexes)), override_data)]
+
+    start = 0
+    if region is not None:
+        start = region[1]
+
+    reports = []
+    for contig, data in groups:
+        if region is not None and contig not in indexes:
+            continue
+        if contig not in indexes:
+            raise ValueError(
+                f"The index override has positions of '{contig}', "
+                "which is not in the reference"
+            )
+        index = indexes[contig]
+        data = data.drop(columns="contig", errors="ignore")
+        positions = data.index.to_numpy(dtype=np.int64)
+        if region is not None:
+            inside = (positions > start) & (positions <= start + len(index))
+            data, positions = data[inside], positions[inside]
+        if len(positions) == 0:
+            continue
+        if positions.max() > start + len(index):
+            raise ValueError(
+                f"The index override has positions beyond the end of '{contig}' "
+                f"({len(index)} nucleotides)"
+            )
+        columns = [_COLUMN_NUMBERS[c] for c in data.columns]
+        rows = positions - 1 - start
+        before = index.counts[rows]
+        index.counts[rows[:, None], columns] = data.to_numpy(dtype=np.int64)
+        # the derived arrays no longer match the counts
+        index.rank_bases = index.rank_counts = None
+        index.deletion_runs = index.minority_deletions = None
+
+        after = index.counts[rows]
+        # the changed columns of every position as a bitmask, which is turned into the
+        # column names per distinct mask
+        changed = (before != after) @ (1 << np.arange(len(INDEX_COLUMNS)))
+        hit = changed > 0
+        masks, inverse = np.unique(changed[hit], return_inverse=True)
+        labels = np.array(
+            [
+                ",".join(c for i, c in enumerate(INDEX_COLUMNS) if m >> i & 1)
+                for m in masks.tolist()
+            ],
+            dtype=object,
+        )
+        reports.append(
+            pd.DataFrame(
+                {
+                    "contig": contig,
+                    "position": positions[hit],
+                    "coverage_before": before[hit, 0],
+                    "coverage_after": after[hit, 0],
+                    "coverage_delta": after[hit, 0] - before[hit, 0],
+                    "changed": labels[inverse.reshape(-1)],
+                },
+                columns=OVERRIDE_REPORT_COLUMNS,
+            )
+        )
+    if not reports:
+        return pd.DataFrame(columns=OVERRIDE_REPORT_COLUMNS)
+    return pd.concat(reports, ignore_index=True)
+
+
+# Lookup table from (uppercase) query-sequence bytes to the A/T/C/G columns of the count
+# matrix, every other character (N, IUPAC codes) is only counted towards the coverage
+_BASE_COLUMNS = np.full(256, -1, dtype=np.int64)
+for _column, _base in enumerate("ATCG", start=1):
+    _BASE_COLUMNS[ord(_base)] = _column
+
+# CIGAR operations that consume the reference and the query (M, =, X)
+_ALIGNED_OPS = (0, 7, 8)
+# CIGAR operations that consume the reference (M, D, N, =, X)
+_REFERENCE_OPS = (0, 2, 3, 7, 8)
+
+
+def _inserted_length(cigar, k):
+    """Gives the length of the insertion directly after the CIGAR operation at index k,
+    this mirrors how htslib assigns insertions to the last base of the preceding
+    operation in a pileup.
+
+    Parameters
+    ----------
+    cigar
+        the cigartuples of the read
+    k
+        index of a reference consuming operation in the cigartuples
+
+    Returns
+    -------
+        The number of inserted bases after the last base of the operation at index k, 0
+        if there is no insertion.
+
+    """
+    length = 0
+    for op, oplen in cigar[k + 1 :]:
+        if op == 1:
+            length += oplen
+        elif op != 6:
+            # padding in between the insertions is skipped, anything else ends the
+            # insertion
+            break
+    return length
+
+
+def PileupCounts(reads, start, end, chunksize=500_000, out=None):
+    """Counts the nucleotides, deletions and insertions of the given reads per reference
+    position, and collects the inserted sequences.
+
+    This gives the same numbers as walking a `nofilter` pileup column by column, but
+    fills preallocated NumPy arrays directly from the aligned blocks of each read. The
+    reads are handled in chunks, and every chunk only touches the stretch of the window
+    that its reads cover. With position sorted reads the memory that is used besides the
+    count matrix therefore depends on the chunk size, not on the length of the window.
+
+    Parameters
+    ----------
+    reads
+        an iterable of pysam.AlignedSegment objects, all on the same reference
+    start
+        0-based start of the reference window that has to be counted
+    end
+        0-based (exclusive) end of the reference window that has to be counted
+    chunksize, optional
+        the number of aligned bases that are collected before the counts are updated in
+        bulk
+    out, optional
+        an array of shape (end - start, 7) that the counts are added to, a new array is
+        made when it isn't given
 
+    Returns
+    -------
+        An array of shape (end - start, 7) with the columns given in INDEX_COLUMNS, and
+        the insertion table of the window: a dictionary with the (uppercase) inserted
+        sequences and their number of reads per 1-based position. The sequences are in
+        the order in which they were first seen.
 
-def BuildIndex(bamfile, ref):
-    """Function takes a BAM file and a reference genome, and returns a dataframe pileup contents for each position in the bamfile.
+    """
+    length = end - start
+    insertions = {}
+    counts = out
+    if counts is None:
+        counts = np.zeros((length, len(INDEX_COLUMNS)), dtype=np.int64)
+
+    def flush(seqs, blocks, spans, dels, inserts):
+        """Adds the collected spans, aligned blocks and insertions of a chunk of reads
+        to the counts"""
+        if not spans:
+            return
+        # every base, deletion and insertion of a read lies within its span, so [lo, hi)
+        # holds the whole chunk
+        r = np.clip(np.array(spans, dtype=np.int64) - start, 0, length)
+        lo, hi = int(r[:, 0].min()), int(r[:, 1].max())
+        size = hi - lo
+        # coverage and deletions are summed from a difference array of the chunk, the
+        # extra element catches the span ends. Nothing is allocated for the rest of the
+        # window, so unsorted reads (which are handed over in many small groups) don't
+        # cost the length of the window per group
+        for column, ranges in ((0, spans), (5, dels)):
+            if ranges:
+                r = np.clip(np.array(ranges, dtype=np.int64) - start, lo, hi) - lo
+                diff = np.bincount(r[:, 0], minlength=size + 1)
+                diff -= np.bincount(r[:, 1], minlength=size + 1)
+                counts[lo:hi, column] += np.cumsum(diff)[:-1]
+        if inserts:
+            i = np.array(inserts, dtype=np.int64) - start
+            i = i[(i >= 0) & (i < length)] - lo
+            counts[lo:hi, 6] += np.bincount(i, minlength=size)
+        if blocks:
+            b = np.array(blocks, dtype=np.int64)
+            sizes = b[:, 2]
+            # offset of every base within its own block
+            within = np.arange(sizes.sum(), dtype=np.int64) - np.repeat(
+                np.cumsum(sizes) - sizes, sizes
+            )
+            rpos = np.repeat(b[:, 0], sizes) + within - start
+            qpos = np.repeat(b[:, 1], sizes) + within
+            column = _BASE_COLUMNS[
+                np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8)[qpos]
+            ]
+            keep = (column > 0) & (rpos >= 0) & (rpos < length)
+            counts[lo:hi, 1:5] += np.bincount(
+                (rpos[keep] - lo) * 4 + (column[keep] - 1), minlength=size * 4
+            ).reshape(size, 4)
+
+    seqs, blocks, spans, dels, inserts = [], [], [], [], []
+    offset = 0
+    collected = 0
+    for read in reads:
+        # unmapped reads are skipped by the pileup engine, even if they are placed on
+        # the reference
+        if read.flag & 4:
+            continue
+        cigar = read.cigartuples
+        if not cigar:
+            continue
+        seq = read.query_sequence
+        rpos = readstart = read.reference_start
+        qpos = 0
+
+        for k, (op, oplen) in enumerate(cigar):
+            if op in _ALIGNED_OPS:
+                if seq is not None:
+                    blocks.append((rpos, offset + qpos, oplen))
+                qpos += oplen
+            elif op == 1 or op == 4:
+                qpos += oplen
+                continue
+            elif op != 2 and op != 3:
+                continue
+
+            inserted = _inserted_length(cigar, k) if k + 1 < len(cigar) else 0
+            if op == 2:
+                # the last position of a deletion that is directly followed by an
+                # insertion shows up as '*+' in the pileup, which is not counted as a
+                # deletion
+                dels.append((rpos, rpos + oplen - (inserted > 0)))
+            rpos += oplen
+            if inserted:
+                inserts.append(rpos - 1)
+                if seq is not None and start < rpos <= end:
+                    # rpos is the 1-based position of the last base before the insertion
+                    position = insertions.setdefault(rpos, {})
+                    bases = seq[qpos : qpos + inserted].upper()
+                    position[bases] = position.get(bases, 0) + 1
+
+        if rpos > readstart:
+            spans.append((readstart, rpos))
+            collected += rpos - readstart
+        if seq is not None:
+            seqs.append(seq)
+            offset += len(seq)
+
+        if collected >= chunksize:
+            flush(seqs, blocks, spans, dels, inserts)
+            seqs, blocks, spans, dels, inserts = [], [], [], [], []
+            offset = 0
+            collected = 0
+    flush(seqs, blocks, spans, dels, inserts)
+    return counts, insertions
+
+
+def _count_region(bamfile, contig, start, end):
+    """Counts the pileup contents of a single region of the reference, used as the unit
+    of work when the index is built in parallel. Every worker opens its own handle to
+    the bam file.
+
+    Reads that cross the edges of the region are fetched by both neighbouring regions,
+    but only the positions within the region itself are counted here.
+
+    Parameters
+    ----------
+    bamfile
+        The path to the (indexed) bam file
+    contig
+        the name of the reference sequence in the bam file
+    start
+        0-based start of the region
+    end
+        0-based (exclusive) end of the region
+
+    Returns
+    -------
+        The count matrix and the insertion table of the region, see PileupCounts.
+
+    """
+    with pysam.AlignmentFile(bamfile, "rb") as bam:
+        return PileupCounts(bam.fetch(contig, start, end), start, end)
+
+
+def _tiles(lengths, threads, minsize=1000):
+    """Splits the references into regions that can be piled up independently. There are
+    a few more regions than threads, so workers that finish early can pick up the next
+    one.
+
+    Parameters
+    ----------
+    lengths
+        a dictionary with the length of every reference sequence
+    threads
+        the number of worker processes
+    minsize, optional
+        the minimum size of a region, smaller regions would mostly spend their time on
+        reads crossing the edges
+
+    Returns
+    -------
+        A list of (contig, start, end) tuples with 0-based start and exclusive end
+        positions.
+
+    """
+    size = max(minsize, -(-sum(lengths.values()) // (threads * 4)))
+    return [
+        (contig, s, min(s + size, length))
+        for contig, length in lengths.items()
+        for s in range(0, length, size)
+    ]
+
+
+def ParseRegion(region, lengths):
+    """Reads a region of the reference in the notation of samtools: the name of a
+    sequence, optionally followed by :start or :start-end (1-based, inclusive). An end
+    beyond the sequence is set to its end, other problems are reported and end the
+    program.
+
+    Parameters
+    ----------
+    region
+        the region as given on the command line
+    lengths
+        the length of every reference sequence
+
+    Returns
+    -------
+        A (contig, start, end) tuple with a 0-based start and an exclusive end.
+
+    """
+    contig, bounds = region, ""
+    if region not in lengths and ":" in region:
+        contig, bounds = region.rsplit(":", 1)
+    if contig not in lengths:
+        print(f"Region {region} is not on a sequence of the reference. Exiting...")
+        sys.exit(1)
+    length = lengths[contig]
+    start, end = 1, length
+    try:
+        if bounds:
+            first, _, last = bounds.replace(",", "").partition("-")
+            start = int(first)
+            if last:
+                end = min(int(last), length)
+    except ValueError:
+        print(f"Region {region} isn't written as contig:start-end. Exiting...")
+        sys.exit(1)
+    if not 1 <= start <= end:
+        print(
+            f"Region {region} is empty or lies beyond the end of {contig} "
+            f"({length} nucleotides). Exiting..."
+        )
+        sys.exit(1)
+    return contig, start - 1, end
+
+
+def MatchContigs(bam, contigs, only=None):
+    """Matches the reference sequences to the reference sequences in the bam file by
+    name. A reference with a single sequence is always matched to the first sequence of
+    the bam file.
+
+    Parameters
+    ----------
+    bam
+        a pysam.AlignmentFile object
+    contigs
+        the names of the sequences in the reference fasta
+    only, optional
+        the names of the sequences that have to be matched, by default all of them
+
+    Returns
+    -------
+        A dictionary with the name in the bam file per reference sequence, None if it is
+        not in the bam file.
+
+    """
+    if len(contigs) == 1:
+        return {contigs[0]: bam.references[0]}
+    if only is not None:
+        contigs = [c for c in contigs if c in only]
+    matched = {c: (c if c in bam.references else None) for c in contigs}
+    missing = [c for c, b in matched.items() if b is None]
+    if missing:
+        print(
+            f"Warning: {len(missing)} sequence(s) of the reference are not in the bam "
+            f"file ({', '.join(missing)}), these have no coverage and become N in the "
+            "outputs",
+            file=sys.stderr,
+        )
+    return matched
+
+
+def _add_insertions(table, inserts):
+    """Adds the read counts of one insertion table to another, see PileupCounts
+
+    Parameters
+    ----------
+    table
+        the insertion table that is updated in place
+    inserts
+        the insertion table with the counts that are added
+
+    """
+    for position, sequences in inserts.items():
+        counted = table.setdefault(position, {})
+        for bases, n in sequences.items():
+            counted[bases] = counted.get(bases, 0) + n
+
+
+def _pileup(bamfile, lengths, threads, region=None):
+    """Counts the pileup contents of every reference sequence, see BuildIndex
 
     Parameters
     ----------
     bamfile
         The path to the bam file
-    ref
-        The reference genome
+    lengths
+        the length of every reference sequence
+    threads
+        The number of processes that are used to pile up separate regions of the
+        reference at the same time
+    region, optional
+        a (contig, start, end) tuple made by ParseRegion, only this region is counted
 
     Returns
     -------
-        A dataframe with the following columns:
-        pos: position in the reference genome
-        coverage: number of reads covering the position
-        A: number of reads with an A at the position
-        T: number of reads with a T at the position
-        C: number of reads with a C at the position
-        G: number of reads with a G at the position
+        A dictionary with an array of shape (length, 7) per reference sequence (or of
+        the region), with the columns given in INDEX_COLUMNS, and a dictionary with the
+        insertion table per reference sequence (see PileupCounts). Positions are counted
+        from the start of the region.
 
     """
-    bamfile = pysam.AlignmentFile(bamfile, "rb")
-    ref_fasta = pysam.FastaFile(ref)
-    ref_length = ref_fasta.lengths[0]
+    windows = {c: (0, l) for c, l in lengths.items()}
+    if region is not None:
+        windows = {region[0]: region[1:]}
+
+    with pysam.AlignmentFile(bamfile, "rb") as bam:
+        bamcontigs = MatchContigs(bam, list(lengths), only=windows)
+        counts = {
+            c: np.zeros((e - s, len(INDEX_COLUMNS)), dtype=np.int64)
+            for c, (s, e) in windows.items()
+        }
+        insertions = {c: {} for c in windows}
+        sizes = {c: e - s for c, (s, e) in windows.items()}
+        tiles = [
+            (c, windows[c][0] + s, windows[c][0] + e)
+            for c, s, e in _tiles(sizes, threads)
+            if bamcontigs[c] is not None
+        ]
+
+        if threads < 2 or len(tiles) < 2 or not bam.has_index():
+            # Reads are streamed from the start of the file, so the bam doesn't have to
+            # be indexed. Only the reads of a region are fetched when it can be.
+            contigs = {
+                bam.get_tid(b): c for c, b in bamcontigs.items() if b is not None
+            }
+            if region is not None and bam.has_index() and contigs:
+                tid = next(iter(contigs))
+                groups = [(tid, bam.fetch(tid=tid, start=region[1], stop=region[2]))]
+            else:
+                groups = itertools.groupby(
+                    bam.fetch(until_eof=True), key=lambda read: read.reference_id
+                )
+            for tid, reads in groups:
+                if tid in contigs:
+                    # the reads of a contig come in more than one group when the bam
+                    # isn't sorted on position, the counts of all groups are added up
+                    c = contigs[tid]
+                    start, end = windows[c]
+                    _, inserts = PileupCounts(reads, start, end, out=counts[c])
+                    _add_insertions(insertions[c], inserts)
+        else:
+            contigs, starts, ends = zip(*tiles)
+            n = len(tiles)
+            with cf.ProcessPoolExecutor(max_workers=min(threads, n)) as xc:
+                regions = xc.map(
+                    _count_region,
+                    [bamfile] * n,
+                    [bamcontigs[c] for c in contigs],
+                    starts,
+                    ends,
+                )
+                for contig, start, end, (counted, inserts) in zip(
+                    contigs, starts, ends, regions
+                ):
+                    offset = windows[contig][0]
+                    counts[contig][start - offset : end - offset] = counted
+                    insertions[contig].update(inserts)
+
+    if region is not None:
+        # the inserted sequences are counted on the positions of the reference
+        insertions = {
+            c: {p - windows[c][0]: v for p, v in table.items()}
+            for c, table in insertions.items()
+        }
+    return counts, insertions
+
+
+class PileupIndex:
+    """Pileup contents of a single reference sequence, stored as NumPy column arrays.
+    Positions are 1-based, row p - 1 of the arrays holds position p. The count array
+    made by BuildIndex is used as it is, without a copy.
 
-    pileup = bamfile.pileup(stepper="nofilter", max_depth=10000000, min_base_quality=0)
+    Parameters
+    ----------
+    counts
+        an array of shape (length, 7) with the columns given in INDEX_COLUMNS
+
+    Attributes
+    ----------
+    counts
+        the count matrix
+    rank_bases, rank_counts
+        per position the nucleotides (A, T, C, G and X) ordered from the highest to the
+        lowest count, and these counts. These are only made by rank, the consensus ranks
+        a block of positions at a time with rank_positions
+    deletion_runs
+        per position the length of the stretch of positions starting there where a
+        deletion is the primary call, made by DeletionRuns on first use
+    minority_deletions
+        per position whether it has enough deletions to be a minority deletion, made by
+        MinorityDeletions on first use
+
+    """
+
+    __slots__ = (
+        "counts",
+        "rank_bases",
+        "rank_counts",
+        "deletion_runs",
+        "minority_deletions",
+    )
+
+    def __init__(self, counts):
+        self.counts = np.ascontiguousarray(counts, dtype=np.int64)
+        self.rank_bases = None
+        self.rank_counts = None
+        self.deletion_runs = None
+        self.minority_deletions = None
 
-    def parse_query_sequences(l):
-        """Takes a list of strings, and returns a tuple of integers
+    def __len__(self):
+        return len(self.counts)
+
+    def __iter__(self):
+        return iter(range(1, len(self.counts) + 1))
+
+    def __contains__(self, p):
+        return 1 <= p <= len(self.counts)
+
+    def keys(self):
+        """The positions of the index"""
+        return range(1, len(self.counts) + 1)
+
+    def column(self, name):
+        """The array of a column of INDEX_COLUMNS,
+        element p - 1 belongs to position p"""
+        return self.counts[:, _COLUMN_NUMBERS[name]]
+
+    @property
+    def coverage(self):
+        return self.counts[:, 0]
+
+    def rank_positions(self, s, e):
+        """Orders the nucleotides of positions s + 1 to e on their count. Ties are
+        broken like sorting the (count, nucleotide) pairs does: the alphabetically last
+        nucleotide comes first.
 
         Parameters
         ----------
-        l
-            the list of bases in the query sequence
+        s
+            0-based start of the positions
+        e
+            0-based (exclusive) end of the positions
 
         Returns
         -------
-            the coverage, a, t, c, g, x, and i values.
+            An array of shape (e - s, 5) with the nucleotides (A, T, C, G and X) of
+            every position from the highest to the lowest count, and an array with
+            these counts.
 
         """
-        coverage = a = c = t = g = x = i = 0
-        for b in l:
-            coverage += 1
-            if b == "*":
-                x += 1
-            elif b[0].lower() == "a":
-                a += 1
-            elif b[0].lower() == "t":
-                t += 1
-            elif b[0].lower() == "c":
-                c += 1
-            elif b[0].lower() == "g":
-                g += 1
-
-            # It is important to count the insertions seperately
-            if "+" in b:
-                i += 1
-        return coverage, a, t, c, g, x, i
-
-    columns = ["pos", "coverage", "A", "T", "C", "G", "X", "I"]
-
-    # 1 Is added to the position because our index starts at 1
-    p_index = pd.DataFrame(
-        (
-            (p.pos + 1,) + parse_query_sequences(p.get_query_sequences(add_indels=True))
-            for p in pileup
-        ),
-        columns=columns,
-    )
+        if self.rank_bases is not None:
+            return self.rank_bases[s:e], self.rank_counts[s:e]
+        block = self.counts[s:e, 1:6]
+        # the count and the alphabetical order of the nucleotide are combined into a
+        # single unique key per column
+        keys = block * len(_DISTRIBUTION) + _ALPHABETICAL
+        order = np.argsort(-keys, axis=1)
+        return _DISTRIBUTION[order], np.take_along_axis(block, order, axis=1)
+
+    def rank(self):
+        """Orders the nucleotides of every position on their count and keeps them in
+        rank_bases and rank_counts, see rank_positions
+        """
+        distribution = self.counts[:, 1:6]
+        rank_bases = np.empty(distribution.shape, dtype=_DISTRIBUTION.dtype)
+        rank_counts = np.empty_like(distribution)
+        # handled in blocks of positions, so the keys and the sort order never take more
+        # memory than a block
+        for s in range(0, len(distribution), _RANK_BLOCK):
+            e = min(s + _RANK_BLOCK, len(distribution))
+            rank_bases[s:e], rank_counts[s:e] = self.rank_positions(s, e)
+        self.rank_bases, self.rank_counts = rank_bases, rank_counts
+
+    def ranked(self, p):
+        """The nucleotides at position p with their counts, from the highest count down
 
-    # Since the pileup does not return positions without any reads mapped, we have to
-    # fill these with zeroes
-    missing_positions = set(range(1, ref_length + 1)) - set(p_index.pos)
-    missing_p_index = pd.DataFrame(
-        ((i, 0, 0, 0, 0, 0, 0, 0) for i in missing_positions), columns=columns
+        Parameters
+        ----------
+        p
+            position in the genome
+
+        Returns
+        -------
+            A list of (nucleotide, count) tuples, with rank 1 first.
+
+        """
+        if not 1 <= p <= len(self.counts):
+            raise KeyError(p)
+        if self.rank_bases is None:
+            self.rank()
+        return list(
+            zip(self.rank_bases[p - 1].tolist(), self.rank_counts[p - 1].tolist())
+        )
+
+
+def InsertionAlleles(insertions, coverage):
+    """Turns the insertion table of a reference sequence into a row per inserted allele
+
+    Parameters
+    ----------
+    insertions
+        the insertion table made by PileupCounts, with the inserted sequences and their
+        number of reads per position
+    coverage
+        the coverage of every position of the reference sequence, starting at position 1
+
+    Returns
+    -------
+        A dataframe with the columns given in ALLELE_COLUMNS:
+        position: the position after which the sequence is inserted
+        sequence: the inserted sequence
+        length: the length of the inserted sequence
+        count: the number of reads with this inserted sequence
+        fraction: the count as a fraction of the coverage of the position
+        The rows are sorted on the position and then on the count (highest first),
+        alleles with the same count are in the order in which they were first seen.
+
+    """
+    positions = np.fromiter(
+        (p for p, alleles in insertions.items() for _ in alleles), dtype=np.int64
+    )
+    seqs = [seq for alleles in insertions.values() for seq in alleles]
+    counts = np.fromiter(
+        (n for alleles in insertions.values() for n in alleles.values()), dtype=np.int64
+    )
+    lengths = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+    table = pd.DataFrame(
+        {
+            "position": positions,
+            "sequence": pd.Series(seqs, dtype=object),
+            "length": lengths,
+            "count": counts,
+            "fraction": counts / coverage[positions - 1],
+        },
+        columns=ALLELE_COLUMNS,
     )
-    p_index = pd.concat([p_index, missing_p_index]).set_index("pos").sort_index()
-    p_index.index.name = None
+    order = np.lexsort((-counts, positions))
+    return table.iloc[order].reset_index(drop=True)
 
-    return p_index
+
+def BuildIndex(bamfile, ref, threads=1, lengths=None, cache=None, region=None):
+    """Function takes a BAM file and a reference genome, and returns the pileup contents
+    for each position of every sequence in the reference genome.
+
+    Parameters
+    ----------
+    bamfile
+        The path to the bam file
+    ref
+        The reference genome
+    threads, optional
+        The number of processes that are used to pile up separate regions of the
+        reference at the same time
+    lengths, optional
+        the length of every reference sequence, when these are already known the fasta
+        index isn't read
+    cache, optional
+        an IndexCache, the counts are loaded from it when this bam file was piled up
+        before and stored in it otherwise
+    region, optional
+        a (contig, start, end) tuple made by ParseRegion, only the reads of this region
+        are piled up and the index only has the positions of the region
+
+    Returns
+    -------
+        A dictionary with a count array of shape (length, 7) per reference sequence, in
+        the order of the reference fasta, and a dictionary with the insertion allele
+        table per reference sequence (see InsertionAlleles). Row p - 1 of an array
+        belongs to position p of the reference sequence, or of the region (positions
+        without any reads have zeroes), its columns are given in INDEX_COLUMNS:
+        coverage: number of reads covering the position
+        A: number of reads with an A at the position
+        T: number of reads with a T at the position
+        C: number of reads with a C at the position
+        G: number of reads with a G at the position
+        X: number of reads with a deletion at the position
+        I: number of reads with an insertion after the position
+
+    """
+    if lengths is None:
+        lengths = ReadReference(ref).lengths
+
+    sizes = lengths
+    if region is not None:
+        sizes = {region[0]: region[2] - region[1]}
+
+    cached = None
+    if cache is not None:
+        key = cache.key(bamfile, ref, lengths, region)
+        cached = cache.load(key, sizes)
+    if cached is not None:
+        counts, insertions = cached
+    else:
+        counts, insertions = _pileup(bamfile, lengths, threads, region)
+        if cache is not None:
+            cache.save(key, counts, insertions)
+
+    Alleles = {
+        contig: InsertionAlleles(insertions[contig], c[:, 0])
+        for contig, c in counts.items()
+    }
+    return counts, Alleles
@@ -0,0 +1,111 @@
+"""Regression benchmark of the consensus and the VCF records of deletion-rich samples.
+The deletions that are already part of the consensus used to be looked up in a list,
+which made these stages quadratic in the length of the genome. The stages are timed on
+synthetic datasets of increasing length with the same density of deletions, the time
+per position has to stay about the same. Run from the root of the repository:
+
+    python -m benchmarks.bench_deletions [--length N] [--depth N] [--deletions F]
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import WriteDataset
+from TrueConsense.indexing import BuildIndex, Gffindex, PileupIndex, ReadReference
+from TrueConsense.Outputs import VariantRecords
+from TrueConsense.Sequences import BuildConsensus
+
+MINCOV = 10
+# the time per position of the longest genome may be this many times the time per
+# position of the shortest one, for a quadratic stage it doubles with every step
+MAXRATIO = 2.0
+
+
+def TimeStages(bamfile, fasta, gff, repeats=3):
+    """Times BuildConsensus and VariantRecords of a dataset, the index is built first
+    and isn't timed
+
+    Parameters
+    ----------
+    bamfile
+        the path to the bam file
+    fasta
+        the path to the reference fasta
+    gff
+        the path to the gff file
+    repeats, optional
+        the number of times the stages are timed, the fastest time is kept
+
+    Returns
+    -------
+        The fastest time in seconds, the length of the reference and the number of
+        deletions in the consensus.
+
+    """
+    references = ReadReference(fasta)
+    contig = next(iter(references))
+    counts, inserts = BuildIndex(bamfile, fasta, lengths=references.lengths)
+    index = PileupIndex(counts[contig])
+    gffdict = Gffindex(gff).df.to_dict("index")
+    sequence = references.sequence(contig)
+
+    best = None
+    for _ in range(repeats):
+        # every repeat starts from a fresh index, the index keeps what it works out
+        index = PileupIndex(index.counts)
+        start = time.perf_counter()
+        _, consensus_noinsert, _, insertpositions = BuildConsensus(
+            MINCOV, index, gffdict, False, inserts[contig]
+        )
+        VariantRecords(
+            contig,
+            sequence,
+            consensus_noinsert,
+            insertpositions,
+            index.coverage,
+            MINCOV,
+        )
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(sequence), consensus_noinsert.count("-")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--length", type=int, default=25000, help="length of the shortest genome"
+    )
+    parser.add_argument("--steps", type=int, default=3, help="number of lengths")
+    parser.add_argument("--depth", type=int, default=60)
+    parser.add_argument("--deletions", type=float, default=0.3, dest="density")
+    args = parser.parse_args()
+
+    rates = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for step in range(args.steps):
+            length = args.length * 2**step
+            dataset = WriteDataset(
+                f"{tmp}/{length}", length, args.depth, args.density, seed=step + 1
+            )
+            elapsed, length, deleted = TimeStages(*dataset)
+            rates.append(elapsed / length)
+            print(
+                f"length {length:>8}  deleted {deleted:>7}  {elapsed:8.3f}s  "
+                f"{rates[-1] * 1e6:6.2f}us per position"
+            )
+
+    ratio = rates[-1] / rates[0]
+    print(f"time per position grew {ratio:.2f} times over {args.steps} lengths")
+    if ratio > MAXRATIO:
+        print(
+            f"Error: the time per position grew more than {MAXRATIO} times, "
+            "the consensus or VCF stage doesn't scale linearly any more",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Benchmark of BuildIndex against the pysam pileup walk it replaced, which classified
+the query sequences of every pileup column in Python. Both are run on a synthetic deep
+coverage dataset, their counts have to be the same. Run from the root of the
+repository:
+
+    python -m benchmarks.bench_pileup [--length N] [--depth N] [--min-speedup F]
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pysam
+
+from benchmarks.synthetic import WriteDataset
+from TrueConsense.indexing import BuildIndex, ReadReference
+
+COLUMNS = ["coverage", "A", "T", "C", "G", "X", "I"]
+
+
+def PileupWalk(bamfile, lengths):
+    """Counts the pileup of every reference sequence one column at a time, the way
+    BuildIndex did before the counts were made from the aligned blocks of the reads
+
+    Parameters
+    ----------
+    bamfile
+        the path to the bam file
+    lengths
+        the length of every reference sequence
+
+    Returns
+    -------
+        A dictionary with an array of shape (length, 7) per reference sequence, with the
+        columns given in COLUMNS.
+
+    """
+    counts = {}
+    with pysam.AlignmentFile(bamfile, "rb") as bam:
+        for contig, length in lengths.items():
+            table = np.zeros((length, len(COLUMNS)), dtype=np.int64)
+            pileup = bam.pileup(
+                contig, stepper="nofilter", max_depth=10000000, min_base_quality=0
+            )
+            for column in pileup:
+                coverage = a = t = c = g = x = i = 0
+                for b in column.get_query_sequences(add_indels=True):
+                    coverage += 1
+                    if b == "*":
+                        x += 1
+                    elif b[0].lower() == "a":
+                        a += 1
+                    elif b[0].lower() == "t":
+                        t += 1
+                    elif b[0].lower() == "c":
+                        c += 1
+                    elif b[0].lower() == "g":
+                        g += 1
+                    # It is important to count the insertions seperately
+                    if "+" in b:
+                        i += 1
+                table[column.pos] = coverage, a, t, c, g, x, i
+            counts[contig] = table
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--length", type=int, default=30000)
+    parser.add_argument("--depth", type=int, default=500)
+    parser.add_argument("--deletions", type=float, default=0.05, dest="density")
+    parser.add_argument(
+        "--min-speedup",
+        type=float,
+        default=1.0,
+        help="fail when BuildIndex isn't this many times faster than the pileup walk",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        bamfile, fasta, _ = WriteDataset(tmp, args.length, args.depth, args.density)
+        lengths = ReadReference(fasta).lengths
+
+        start = time.perf_counter()
+        expected = PileupWalk(bamfile, lengths)
+        walk = time.perf_counter() - start
+
+        start = time.perf_counter()
+        counts, _ = BuildIndex(bamfile, fasta, lengths=lengths)
+        index = time.perf_counter() - start
+
+    for contig, table in expected.items():
+        if not np.array_equal(counts[contig], table):
+            print(
+                f"Error: the counts of BuildIndex for {contig} differ from the "
+                "pileup walk",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+
+    speedup = walk / index
+    print(f"pileup walk {walk:8.3f}s")
+    print(f"BuildIndex  {index:8.3f}s  ({speedup:.1f} times faster)")
+    if speedup < args.min_speedup:
+        print(
+            f"Error: BuildIndex is less than {args.min_speedup} times faster than the "
+            "pileup walk",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
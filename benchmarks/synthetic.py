@@ -0,0 +1,194 @@
+"""Writes synthetic datasets (a reference fasta, gff and a sorted and indexed bam file)
+for the benchmarks. Run from the root of the repository:
+
+    python -m benchmarks.synthetic OUTDIR [--length N] [--depth N] [--deletions F]
+"""
+
+import argparse
+import os
+import random
+
+import pysam
+
+STOPCODONS = ("TAA", "TAG", "TGA")
+READLENGTH = 150
+
+
+def _random_codon(rng):
+    while True:
+        codon = "".join(rng.choice("ACGT") for _ in range(3))
+        if codon not in STOPCODONS:
+            return codon
+
+
+def MakeReference(rng, length, genelength=3000):
+    """Makes a random reference sequence with an ORF every genelength nucleotides
+
+    Parameters
+    ----------
+    rng
+        a random.Random
+    length
+        the length of the reference sequence
+    genelength, optional
+        the length of every ORF, including the start and stop codon
+
+    Returns
+    -------
+        The reference sequence, and a list with the (1-based, inclusive) start and end
+        of every ORF.
+
+    """
+    sequence = [rng.choice("ACGT") for _ in range(length)]
+    genes = []
+    for start in range(101, length - genelength - 100, genelength + 200):
+        codons = ["ATG"]
+        codons += [_random_codon(rng) for _ in range(genelength // 3 - 2)]
+        codons.append(rng.choice(STOPCODONS))
+        end = start + genelength - 1
+        sequence[start - 1 : end] = "".join(codons)
+        genes.append((start, end))
+    return "".join(sequence), genes
+
+
+def MakeDeletions(rng, length, density):
+    """Places deletion events along the reference sequence. About half of them are
+    carried by the majority of the reads, the others are minority deletions. Their
+    lengths are a mix of whole codons and frameshifts.
+
+    Parameters
+    ----------
+    rng
+        a random.Random
+    length
+        the length of the reference sequence
+    density
+        the fraction of the reference sequence that lies within a deletion event
+
+    Returns
+    -------
+        A sorted list of (start, length, fraction of the reads) tuples, with a 0-based
+        start.
+
+    """
+    events = []
+    p = READLENGTH
+    while p < length - READLENGTH:
+        size = rng.choice((1, 2, 3, 6, 9, 12, 30, 60, 100))
+        if rng.random() < density * 40 / size:
+            fraction = rng.choice((0.9, 0.7, 0.3, 0.1))
+            events.append((p, size, fraction))
+            p += size
+        p += 40
+    return events
+
+
+def _read(rng, reference, deletions, start):
+    """A read of READLENGTH query bases from start, with the deletions it carries"""
+    sequence, cigar = [], []
+    p, q = start, 0
+    for dstart, dlength, fraction in deletions:
+        if dstart <= p:
+            continue
+        if dstart - p >= READLENGTH - q:
+            break
+        if rng.random() >= fraction:
+            continue
+        sequence.append(reference[p:dstart])
+        cigar += [(0, dstart - p), (2, dlength)]
+        q += dstart - p
+        p = dstart + dlength
+    sequence.append(reference[p : p + READLENGTH - q])
+    cigar.append((0, len(sequence[-1])))
+    # a read never ends with a deletion, also not at the end of the reference
+    cigar = [op for op in cigar if op[1] > 0]
+    while cigar[-1][0] == 2:
+        cigar.pop()
+    return "".join(sequence), cigar
+
+
+def WriteDataset(directory, length=30000, depth=200, density=0.15, seed=1):
+    """Writes a reference fasta, a gff file with the ORFs of the reference and a sorted
+    and indexed bam file with reads that carry many deletions to a directory
+
+    Parameters
+    ----------
+    directory
+        the directory for the files, it is made when it doesn't exist
+    length, optional
+        the length of the reference sequence
+    depth, optional
+        the mean depth of coverage
+    density, optional
+        the fraction of the reference sequence that lies within a deletion event
+    seed, optional
+        the seed of the random numbers, the same seed gives the same dataset
+
+    Returns
+    -------
+        The paths of the bam file, the reference fasta and the gff file.
+
+    """
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    reference, genes = MakeReference(rng, length)
+    deletions = MakeDeletions(rng, length, density)
+
+    fasta = os.path.join(directory, "ref.fasta")
+    with open(fasta, "w") as out:
+        out.write(">ref\n")
+        for i in range(0, length, 70):
+            out.write(reference[i : i + 70] + "\n")
+    pysam.faidx(fasta)
+
+    gff = os.path.join(directory, "ref.gff")
+    with open(gff, "w") as out:
+        out.write("##gff-version 3\n")
+        for n, (start, end) in enumerate(genes, 1):
+            out.write(
+                f"ref\tsynthetic\tCDS\t{start}\t{end}\t.\t+\t0\t"
+                f"ID=cds{n};Name=gene{n}\n"
+            )
+
+    header = pysam.AlignmentHeader.from_dict(
+        {"HD": {"VN": "1.6"}, "SQ": [{"SN": "ref", "LN": length}]}
+    )
+    unsorted = os.path.join(directory, "unsorted.bam")
+    with pysam.AlignmentFile(unsorted, "wb", header=header) as bam:
+        for n in range(depth * length // READLENGTH):
+            start = rng.randrange(0, length - 2 * READLENGTH)
+            sequence, cigar = _read(rng, reference, deletions, start)
+            read = pysam.AlignedSegment(header)
+            read.query_name = f"read{n}"
+            read.reference_id = 0
+            read.reference_start = start
+            read.mapping_quality = 60
+            read.flag = 16 if n % 2 else 0
+            read.query_sequence = sequence
+            read.cigartuples = cigar
+            read.query_qualities = pysam.qualitystring_to_array("I" * len(sequence))
+            bam.write(read)
+
+    bamfile = os.path.join(directory, "in.bam")
+    pysam.sort("-o", bamfile, unsorted)
+    pysam.index(bamfile)
+    os.remove(unsorted)
+    return bamfile, fasta, gff
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory", help="the directory to write the dataset to")
+    parser.add_argument("--length", type=int, default=30000)
+    parser.add_argument("--depth", type=int, default=200)
+    parser.add_argument("--deletions", type=float, default=0.15, dest="density")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    for path in WriteDataset(
+        args.directory, args.length, args.depth, args.density, args.seed
+    ):
+        print(path)
+
+
+if __name__ == "__main__":
+    main()
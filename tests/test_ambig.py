@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from TrueConsense.Ambig import AmbiguityCodes, IsAmbiguous
+from TrueConsense.indexing import PileupIndex
+
+
+def _random_index(rng, length):
+    """Count matrix with small counts, so that ties and nucleotides within 10% of each
+    other are common, and with some positions without coverage"""
+    counts = np.zeros((length, 7), dtype=np.int64)
+    counts[:, 1:6] = rng.integers(0, 12, size=(length, 5))
+    # the coverage also includes reads that don't have one of the nucleotides here
+    counts[:, 0] = counts[:, 1:6].sum(axis=1) + rng.integers(0, 3, size=length)
+    counts[rng.random(length) < 0.05] = 0
+    return PileupIndex(counts)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_ambiguity_codes_match_is_ambiguous(seed):
+    rng = np.random.default_rng(seed)
+    index = _random_index(rng, 5000)
+    index.rank()
+
+    codes = AmbiguityCodes(
+        index.rank_bases, index.rank_counts, index.coverage, blocksize=777
+    )
+
+    for p in index:
+        ambiguous, char = IsAmbiguous(*index.ranked(p)[:4], int(index.coverage[p - 1]))
+        assert codes[p - 1] == (char if ambiguous else ""), index.ranked(p)
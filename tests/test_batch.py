@@ -0,0 +1,20 @@
+import numpy as np
+
+from TrueConsense.Batch import SUMMARY_COLUMNS, Summarise
+from TrueConsense.indexing import PileupIndex
+
+
+def test_summary_counts_ambiguity_codes_and_deletions_separately():
+    counts = np.zeros((12, 7), dtype=np.int64)
+    counts[:, 0] = 20
+    consensus = {"ref": ("ACGTRyk--nNa", "ACGTRyk--nNa", {}, None)}
+
+    summary = Summarise(
+        {"samplename": "s1"}, 10, {"ref": PileupIndex(counts)}, consensus
+    )
+
+    assert list(summary) == SUMMARY_COLUMNS
+    assert summary["ambiguous"] == 3
+    assert summary["deletions"] == 2
+    assert summary["N"] == 2
+    assert summary["length"] == 12
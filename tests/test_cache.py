@@ -0,0 +1,96 @@
+import os
+
+import numpy as np
+import pysam
+import pytest
+
+from TrueConsense.Cache import STALE_TEMPFILE_AGE, IndexCache
+
+LENGTHS = {"ref": 100}
+
+
+def _write_bam(path, nreads):
+    header = pysam.AlignmentHeader.from_dict(
+        {"HD": {"VN": "1.6"}, "SQ": [{"SN": "ref", "LN": 100}]}
+    )
+    with pysam.AlignmentFile(str(path), "wb", header=header) as bam:
+        for n in range(nreads):
+            read = pysam.AlignedSegment(header)
+            read.query_name = f"r{n}"
+            read.reference_id = 0
+            read.reference_start = n
+            read.query_sequence = "ACGTACGTAC"
+            read.cigartuples = [(0, 10)]
+            bam.write(read)
+    return str(path)
+
+
+def _entry(value):
+    counts = {"ref": np.full((100, 7), value, dtype=np.int64)}
+    insertions = {"ref": {5: {"AC": value}}}
+    return counts, insertions
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    ref = tmp_path / "ref.fasta"
+    ref.write_text(">ref\n" + "A" * 100 + "\n")
+    return _write_bam(tmp_path / "in.bam", 5), str(ref)
+
+
+def test_key_changes_with_bam_mtime_and_size(tmp_path, inputs):
+    bamfile, ref = inputs
+    cache = IndexCache(str(tmp_path / "cache"))
+    key = cache.key(bamfile, ref, LENGTHS)
+    assert cache.key(bamfile, ref, LENGTHS) == key
+
+    st = os.stat(bamfile)
+    os.utime(bamfile, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    touched = cache.key(bamfile, ref, LENGTHS)
+    assert touched != key
+
+    _write_bam(bamfile, 20)
+    os.utime(bamfile, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert os.stat(bamfile).st_size != st.st_size
+    assert cache.key(bamfile, ref, LENGTHS) not in (key, touched)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = IndexCache(str(tmp_path), maxsize=1 << 40)
+    cache.save("a", *_entry(1))
+    size = os.path.getsize(cache.path("a"))
+    cache.maxsize = int(size * 2.5)
+    cache.save("b", *_entry(2))
+    # a is older than b, but it is used again after b was saved
+    os.utime(cache.path("a"), (1000, 1000))
+    os.utime(cache.path("b"), (2000, 2000))
+    assert cache.load("a", LENGTHS) is not None
+
+    cache.save("c", *_entry(3))
+
+    assert os.path.exists(cache.path("a"))
+    assert not os.path.exists(cache.path("b"))
+    counts, insertions = cache.load("c", LENGTHS)
+    np.testing.assert_array_equal(counts["ref"], _entry(3)[0]["ref"])
+    assert insertions == _entry(3)[1]
+
+
+def test_refresh_skips_loading(tmp_path):
+    IndexCache(str(tmp_path)).save("a", *_entry(1))
+
+    assert IndexCache(str(tmp_path)).load("a", LENGTHS) is not None
+    assert IndexCache(str(tmp_path), refresh=True).load("a", LENGTHS) is None
+
+
+def test_prune_removes_stale_temporary_files(tmp_path):
+    stale = tmp_path / "killed.npz.tmp"
+    fresh = tmp_path / "writing.npz.tmp"
+    stale.write_bytes(b"x")
+    fresh.write_bytes(b"x")
+    old = os.stat(stale).st_mtime - STALE_TEMPFILE_AGE - 60
+    os.utime(stale, (old, old))
+
+    IndexCache(str(tmp_path)).prune()
+
+    assert not stale.exists()
+    assert fresh.exists()
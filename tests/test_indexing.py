@@ -0,0 +1,163 @@
+import random
+
+import numpy as np
+import pysam
+import pytest
+
+from TrueConsense.indexing import ParseRegion, _pileup, _tiles
+
+LENGTHS = {"chr1": 3000, "chr2": 800}
+
+
+def _aligned_reads(header, references, rng):
+    """Reads on both reference sequences. Of the reads on chr1 every third read has an
+    AAG insertion after position 651, and another third a GT insertion after position
+    1000, the last position of the first region that is piled up separately"""
+    reads = []
+    for n in range(1200):
+        contig = rng.choice(list(LENGTHS))
+        tid = header.get_tid(contig)
+        read = pysam.AlignedSegment(header)
+        read.query_name = f"r{n}"
+        read.reference_id = tid
+        read.mapping_quality = 60
+        if contig == "chr1" and n % 3 < 2:
+            start, inserted = (621, "AAG") if n % 3 == 0 else (970, "GT")
+            ref = references[contig]
+            read.query_sequence = (
+                ref[start : start + 30] + inserted + ref[start + 30 : start + 60]
+            )
+            read.cigartuples = [(0, 30), (1, len(inserted)), (0, 30)]
+        else:
+            start = rng.randrange(0, LENGTHS[contig] - 60)
+            read.query_sequence = references[contig][start : start + 60]
+            read.cigartuples = [(0, 60)]
+        read.reference_start = start
+        read.flag = 16 if n % 2 else 0
+        reads.append(read)
+    return reads
+
+
+def _unmapped_read(header, n):
+    read = pysam.AlignedSegment(header)
+    read.query_name = f"u{n}"
+    read.flag = 4
+    read.reference_id = -1
+    read.reference_start = -1
+    read.query_sequence = "ACGTACGT"
+    return read
+
+
+def _write_bam(path, header, reads, index=False):
+    with pysam.AlignmentFile(str(path), "wb", header=header) as bam:
+        for read in reads:
+            bam.write(read)
+    if index:
+        pysam.index(str(path))
+    return str(path)
+
+
+@pytest.fixture
+def bams(tmp_path):
+    rng = random.Random(9)
+    references = {
+        c: "".join(rng.choice("ACGT") for _ in range(l)) for c, l in LENGTHS.items()
+    }
+    header = pysam.AlignmentHeader.from_dict(
+        {
+            "HD": {"VN": "1.6", "SO": "coordinate"},
+            "SQ": [{"SN": c, "LN": l} for c, l in LENGTHS.items()],
+        }
+    )
+    reads = _aligned_reads(header, references, rng)
+    ordered = sorted(reads, key=lambda read: (read.reference_id, read.reference_start))
+
+    shuffled = reads[:]
+    rng.shuffle(shuffled)
+    # unmapped reads in between split the reads of a contig in even more groups
+    interleaved = []
+    for n, read in enumerate(shuffled):
+        interleaved.append(read)
+        if n % 5 == 0:
+            interleaved.append(_unmapped_read(header, n))
+
+    inserted = sum(1 for read in reads if (1, 3) in read.cigartuples)
+    return (
+        _write_bam(tmp_path / "sorted.bam", header, ordered, index=True),
+        _write_bam(tmp_path / "shuffled.bam", header, interleaved),
+        inserted,
+    )
+
+
+def test_pileup_of_shuffled_bam_matches_sorted_bam(bams):
+    ordered, shuffled, inserted = bams
+    counts, insertions = _pileup(ordered, LENGTHS, 1)
+    shuffled_counts, shuffled_insertions = _pileup(shuffled, LENGTHS, 1)
+
+    for contig in LENGTHS:
+        np.testing.assert_array_equal(counts[contig], shuffled_counts[contig])
+    assert shuffled_insertions == insertions
+
+
+def test_insertions_of_shuffled_bam_are_summed(bams):
+    _, shuffled, inserted = bams
+    counts, insertions = _pileup(shuffled, LENGTHS, 1)
+
+    assert insertions["chr1"][651] == {"AAG": inserted}
+    assert counts["chr1"][650, 6] == inserted
+    assert insertions["chr2"] == {}
+
+
+def test_reference_sequence_missing_from_bam_is_reported(bams, capsys):
+    ordered, _, _ = bams
+    counts, _ = _pileup(ordered, {**LENGTHS, "chr3": 500}, 1)
+
+    assert "chr3" in capsys.readouterr().err
+    assert not counts["chr3"].any()
+    np.testing.assert_array_equal(
+        counts["chr1"], _pileup(ordered, LENGTHS, 1)[0]["chr1"]
+    )
+
+
+def test_pileup_in_regions_matches_streamed_pileup(bams):
+    ordered, _, _ = bams
+    # chr1 is split in regions of 1000 positions, reads and the GT insertion after
+    # position 1000 lie on the edge of the first two regions
+    assert ("chr1", 0, 1000) in _tiles(LENGTHS, 3)
+    counts, insertions = _pileup(ordered, LENGTHS, 1)
+    tiled_counts, tiled_insertions = _pileup(ordered, LENGTHS, 3)
+
+    for contig in LENGTHS:
+        np.testing.assert_array_equal(counts[contig], tiled_counts[contig])
+    assert tiled_insertions == insertions
+    assert set(tiled_insertions["chr1"][1000]) == {"GT"}
+
+
+@pytest.mark.parametrize("threads", [1, 3])
+def test_pileup_of_region_matches_part_of_whole_pileup(bams, threads):
+    ordered, shuffled, _ = bams
+    region = ParseRegion("chr1:601-1,500", LENGTHS)
+    assert region == ("chr1", 600, 1500)
+    counts, insertions = _pileup(ordered, LENGTHS, 1)
+
+    # the sorted bam is fetched from its index, the shuffled one is streamed
+    for bamfile in (ordered, shuffled):
+        region_counts, region_insertions = _pileup(bamfile, LENGTHS, threads, region)
+
+        assert list(region_counts) == ["chr1"]
+        np.testing.assert_array_equal(region_counts["chr1"], counts["chr1"][600:1500])
+        # the inserted sequences are on the positions within the region
+        assert region_insertions["chr1"] == {
+            p - 600: v for p, v in insertions["chr1"].items() if 600 < p <= 1500
+        }
+        assert set(region_insertions["chr1"]) == {51, 400}
+
+
+def test_region_notations():
+    assert ParseRegion("chr2", LENGTHS) == ("chr2", 0, 800)
+    assert ParseRegion("chr2:101", LENGTHS) == ("chr2", 100, 800)
+    # the end is cut off at the end of the sequence, like samtools does
+    assert ParseRegion("chr2:101-5000", LENGTHS) == ("chr2", 100, 800)
+    for region in ("chr3:1-10", "chr2:0-10", "chr2:20-10", "chr2:1-x"):
+        with pytest.raises(SystemExit):
+            ParseRegion(region, LENGTHS)
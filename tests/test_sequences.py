@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+from TrueConsense.indexing import PileupIndex
+from TrueConsense.Sequences import BuildConsensus
+
+REFERENCE = "ATG" + "AAA" * 9
+
+
+def _orf_with_insertion():
+    """An ORF over the whole reference, with a T inserted after position 3 that turns
+    the second codon into a stop codon, and a deletion as primary call at position 20
+    with C as secondary call"""
+    counts = np.zeros((len(REFERENCE), 7), dtype=np.int64)
+    counts[:, 0] = 50
+    for i, n in enumerate(REFERENCE):
+        counts[i, 1 + "ATCG".index(n)] = 50
+    counts[2, 6] = 50
+    counts[19, 1:6] = [0, 0, 20, 0, 30]
+    alleles = pd.DataFrame(
+        {
+            "position": pd.Series([3], dtype=np.int64),
+            "sequence": pd.Series(["T"], dtype=object),
+            "length": pd.Series([1], dtype=np.int64),
+            "count": pd.Series([50], dtype=np.int64),
+            "fraction": pd.Series([1.0]),
+        }
+    )
+    gff = {
+        0: {
+            "seqid": "ref",
+            "source": "test",
+            "type": "CDS",
+            "start": 1,
+            "end": len(REFERENCE),
+            "score": ".",
+            "strand": "+",
+            "phase": 0,
+            "attributes": "ID=cds1;Name=gene1",
+        }
+    }
+    return PileupIndex(counts), gff, alleles
+
+
+def test_consensus_without_insertions_follows_its_own_orfs():
+    index, gff, alleles = _orf_with_insertion()
+
+    consensus, consensus_noinsert, newgff, _ = BuildConsensus(
+        10, index, gff, False, alleles
+    )
+
+    # with the insertion the ORF ends at the new stop codon, the deletion lies beyond it
+    assert consensus == "ATGT" + "A" * 16 + "-" + "A" * 10
+    assert newgff[0]["end"] == 6
+    # without the insertion the ORF continues, the deletion would break the reading
+    # frame so the secondary call is used
+    assert consensus_noinsert == "ATG" + "A" * 16 + "C" + "A" * 10